@@ -1392,12 +1392,12 @@ class BlockstackdRPC( SimpleXMLRPCServer):
         if length > 524288:
             return {'error': 'Request length too large'}
 
-        zonefile_inv = atlas_get_zonefile_inventory( offset=offset, length=length )
-
         if os.environ.get("BLOCKSTACK_TEST", None) == "1":
+            zonefile_inv = atlas_get_zonefile_inventory( offset=offset, length=length )
             log.debug("Zonefile inventory is '%s'" % (atlas_inventory_to_string(zonefile_inv)))
 
-        return self.success_response( {'inv': base64.b64encode(zonefile_inv) } )
+        zonefile_inv_b64 = atlas_get_zonefile_inventory_b64( offset=offset, length=length )
+        return self.success_response( {'inv': zonefile_inv_b64 } )
 
 
     def rpc_get_all_neighbor_info( self, **con_info ):
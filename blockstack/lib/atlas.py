@@ -29,6 +29,7 @@ import urllib2
 import simplejson
 import threading
 import random
+import re
 import struct
 import base64
 import shutil
@@ -40,6 +41,10 @@ import hashlib
 import errno
 import socket
 import gc
+import collections
+import heapq
+
+from multiprocessing.pool import ThreadPool
 
 import blockstack_zones
 import virtualchain
@@ -73,18 +78,32 @@ PEER_INV_TIMEOUT  = 10  # number of seconds for an inv to take
 PEER_NEIGHBORS_TIMEOUT = 10 # number of seconds for a neighbors query to take
 PEER_ZONEFILES_TIMEOUT = 30 # number of seconds for a zonefile query to take
 PEER_PUSH_ZONEFILES_TIMEOUT = 10
+PEER_INV_DOWNLOAD_THREADS = 8   # maximum number of inventory ranges to fetch from a peer at once
+PEER_ZONEFILE_FETCH_THREADS = None  # maximum number of peers to fetch zonefiles from at once (None means atlas_max_neighbors())
 
 PEER_CRAWL_NEIGHBOR_WORK_INTERVAL = 300     # minimum amount of time (seconds) that must pass between two neighbor crawls
 PEER_HEALTH_NEIGHBOR_WORK_INTERVAL = 1      # minimum amount of time (seconds) that must pass between randomly pinging someone
 PEER_CRAWL_ZONEFILE_WORK_INTERVAL = 300     # minimum amount of time (seconds) that must pass between two zonefile crawls
 PEER_PUSH_ZONEFILE_WORK_INTERVAL = 300      # minimum amount of time (seconds) that must pass between two zonefile pushes
 PEER_CRAWL_ZONEFILE_STORAGE_RETRY_INTERVAL = 3600 * 12      # retry storage for missing zonefiles every 12 hours
+PEER_CRAWL_ZONEFILE_BATCH_SIZE = 10000      # maximum number of (rarest) obtainable missing zonefiles to go after in one zonefile crawl
+PEER_IDLE_WAIT_JITTER = 0.1         # idle waits between work intervals are stretched by a random fraction up to this much
 
 NUM_NEIGHBORS = 80     # number of neighbors a peer can report
 
-ZONEFILE_INV = None      # this atlas peer's current zonefile inventory
+ZONEFILE_INV = None      # this atlas peer's current zonefile inventory (a bytearray)
+ZONEFILE_INV_GENERATION = 0     # incremented each time ZONEFILE_INV changes
+ZONEFILE_INV_B64_CACHE = (0, {})    # (generation, {(offset, length): base64-encoded inventory})
+ZONEFILE_INV_B64_CACHE_MAX = 64     # maximum number of encoded inventory slices to keep
 NUM_ZONEFILES = 0      # cache-coherent count of the number of zonefiles present
 
+MISSING_ZONEFILES = None    # cache of the zonefile rows we don't have, as {inv_index: row}
+MISSING_ZONEFILES_LOCK = threading.Lock()
+
+ZONEFILE_BITS_CACHE = {}    # cache of atlasdb_get_zonefile_bits(), as {(db path, zonefile hash): [bits]}
+ZONEFILE_BITS_CACHE_MAX = 65536     # maximum number of zonefile hashes to remember bits for
+ZONEFILE_BITS_CACHE_LOCK = threading.Lock()
+
 MAX_QUEUED_ZONEFILES = 1000     # maximum number of queued zonefiles
 
 if os.environ.get("BLOCKSTACK_ATLAS_PEER_LIFETIME") is not None:
@@ -131,6 +150,56 @@ def time_sleep(hostport, procname, value):
 
     return time.sleep(value)
 
+def time_sleep_wakeup(hostport, procname, value, wakeup):
+    """
+    Sleep for up to value seconds, or until the given
+    threading.Event is set (whichever comes first).
+    Return True if we were woken up (and clear the event).
+    Return False on timeout.
+    """
+    global ATLAS_TEST
+    if ATLAS_TEST:
+        # test harness controls time; keep its 1-second granularity
+        time_sleep(hostport, procname, 1.0)
+    else:
+        wakeup.wait(value)
+
+    if wakeup.is_set():
+        wakeup.clear()
+        return True
+
+    return False
+
+def atlas_idle_deadline(work_interval, elapsed):
+    """
+    Get the time at which an idle worker thread should wake up,
+    given its minimum work interval and how long its last step took.
+    The wait is stretched by a random amount (up to PEER_IDLE_WAIT_JITTER)
+    so threads and nodes that start together do not stay in lockstep.
+    """
+    global ATLAS_TEST
+    wait = work_interval - elapsed
+    if not ATLAS_TEST:
+        wait *= random.uniform(1.0, 1.0 + PEER_IDLE_WAIT_JITTER)
+
+    return time_now() + wait
+
+def time_sleep_until(hostport, procname, deadline, wakeup):
+    """
+    Sleep until the given deadline (as given by time_now()),
+    or until the given threading.Event is set.
+    Reads the clock once per wait.
+    Return True if we were woken up.
+    Return False once the deadline passes.
+    """
+    while True:
+        remaining = deadline - time_now()
+        if remaining <= 0:
+            return False
+
+        if time_sleep_wakeup(hostport, procname, remaining, wakeup):
+            return True
+
 def atlas_max_neighbors():
     global ATLAS_TEST
     if ATLAS_TEST:
@@ -225,6 +294,65 @@ def get_rpc_client_class():
         return BlockstackRPCClient
 
 
+INVENTORY_NONZERO_BYTE_PATTERN = re.compile(r"[^\x00]")     # finds the bytes in an inventory vector with any bits set
+
+RPC_CLIENTS = threading.local()     # per-thread cache of RPC clients, keyed by peer host:port (least-recently-used first)
+RPC_CLIENTS_MAX = 128               # maximum number of RPC clients each thread keeps
+RPC_MIN_TIMEOUT = 1.0               # never give a peer less than this many seconds to respond
+
+def atlas_peer_rpc_client( peer_hostport, timeout, src=None ):
+    """
+    Get an RPC client for a peer.
+    Clients are reused across calls to the same peer (with the same
+    timeout and source), so we don't rebuild the proxy and transport
+    every time.  Each thread gets its own clients, and keeps
+    at most RPC_CLIENTS_MAX of them (evicting the least-recently-used).
+    """
+    global RPC_CLIENTS, RPC_CLIENTS_MAX, RPC_MIN_TIMEOUT
+
+    clients = getattr(RPC_CLIENTS, "clients", None)
+    if clients is None:
+        clients = collections.OrderedDict()
+        RPC_CLIENTS.clients = clients
+
+    if timeout is not None:
+        timeout = max(RPC_MIN_TIMEOUT, timeout)
+
+    client_key = (timeout, src)
+    cached = clients.pop(peer_hostport, None)
+    if cached is not None and cached[0] == client_key:
+        # most-recently-used goes last
+        clients[peer_hostport] = cached
+        return cached[1]
+
+    host, port = url_to_host_port( peer_hostport )
+    RPC = get_rpc_client_class()
+    if src is not None:
+        rpc = RPC( host, port, timeout=timeout, src=src )
+    else:
+        rpc = RPC( host, port, timeout=timeout )
+
+    clients[peer_hostport] = (client_key, rpc)
+    while len(clients) > RPC_CLIENTS_MAX:
+        clients.popitem(last=False)
+
+    return rpc
+
+
+def atlas_peer_rpc_client_evict( peer_hostport ):
+    """
+    Forget this thread's RPC client for a peer
+    (i.e. after a socket error).
+    """
+    global RPC_CLIENTS
+
+    clients = getattr(RPC_CLIENTS, "clients", None)
+    if clients is not None and peer_hostport in clients:
+        del clients[peer_hostport]
+
+    return True
+
+
 ATLASDB_SQL = """
 CREATE TABLE zonefiles( inv_index INTEGER PRIMARY KEY AUTOINCREMENT,
                         name STRING NOT NULL,
@@ -240,20 +368,91 @@ CREATE TABLE peers( peer_index INTEGER PRIMARY KEY AUTOINCREMENT,
                     discovery_time INTEGER NOT NULL );
 """
 
+# indexes on the zonefiles table.
+# created after the initial bulk load, and added to existing databases on startup.
+ATLASDB_INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS zonefiles_zonefile_hash_index ON zonefiles( zonefile_hash );
+CREATE INDEX IF NOT EXISTS zonefiles_block_height_index ON zonefiles( block_height, inv_index );
+"""
+
+ATLASDB_CACHED_STATEMENTS = 256     # number of compiled statements to keep per db connection
+
 PEER_TABLE = {}        # map peer host:port (NOT url) to peer information
-                       # each element is {'time': [(responded, timestamp)...], 'zonefile_inv': ...}
+                       # each element is {'time': deque([(timestamp, responded)...]), 'num_requests': ..., 'num_responses': ..., 'zonefile_inv': ...}
+                       # 'num_requests' and 'num_responses' are running counts over 'time', so health checks don't have to walk it
+                       # 'lock' guards 'time', 'num_requests', and 'num_responses'.  Lock ordering: PEER_TABLE_LOCK (if needed)
+                       # is always taken before a peer's lock, and no thread holds two peers' locks at once.
+                       # PEER_TABLE_LOCK may be read-locked (atlas_peer_table_rlock) by code that does not add or remove peers or change 'zonefile_inv'.
                        # 'zonefile_inv' is a *bitwise big-endian* bit string where bit i is set if the zonefile in the ith NAME_UPDATE transaction has been stored by us (i.e. "is present")
                        # for example, if 'zonefile_inv' is 10110001, then the 0th, 2nd, 3rd, and 7th NAME_UPDATEs' zonefiles have been stored by us
                        # (note that we allow for the possibility of duplicate zonefiles, but this is a rare occurance and we keep track of it in the DB to avoid duplicate transfers)
 
-PEER_QUEUE = []        # list of peers (host:port) to begin talking to, discovered via the Atlas RPC interface
-ZONEFILE_QUEUE = []    # list of {zonefile_hash: zonefile} dicts to push out to other Atlas nodes (i.e. received from clients)
+PEER_QUEUE = collections.deque()        # FIFO of peers (host:port) to begin talking to, discovered via the Atlas RPC interface
+ZONEFILE_QUEUE = collections.deque()    # FIFO of {zonefile_hash: zonefile} dicts to push out to other Atlas nodes (i.e. received from clients)
+
+class AtlasRWLock(object):
+    """
+    Readers-writer lock:  any number of readers, or one writer.
+    Waiting writers keep new readers out, so writers don't starve.
+    Not reentrant.
+    """
+    def __init__(self):
+        self.cond = threading.Condition( threading.Lock() )
+        self.readers = set([])
+        self.writer = None
+        self.writers_waiting = 0
+
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self.cond:
+            while self.writer is not None or self.writers_waiting > 0:
+                self.cond.wait()
+
+            self.readers.add( me )
+
+
+    def release_read(self):
+        me = threading.current_thread()
+        with self.cond:
+            self.readers.remove( me )
+            if len(self.readers) == 0:
+                self.cond.notify_all()
+
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer is not None or len(self.readers) > 0:
+                self.cond.wait()
+
+            self.writers_waiting -= 1
+            self.writer = me
 
-PEER_TABLE_LOCK = threading.Lock()
+
+    def release_write(self):
+        with self.cond:
+            self.writer = None
+            self.cond.notify_all()
+
+
+    def is_read_locked(self):
+        return len(self.readers) > 0
+
+
+    def is_read_locked_by_me(self):
+        return threading.current_thread() in self.readers
+
+
+PEER_TABLE_LOCK = AtlasRWLock()     # read-locked by code that only looks at the table; write-locked by everyone else
 PEER_QUEUE_LOCK = threading.Lock()
 PEER_TABLE_LOCK_HOLDER = None
 PEER_TABLE_LOCK_TRACEBACK = None
 ZONEFILE_QUEUE_LOCK = threading.Lock()
+ZONEFILE_QUEUE_WAKEUP = threading.Event()     # set whenever a zonefile is enqueued, so the pusher need not poll
+PEER_INV_DOWNLOAD_POOL = None       # shared ThreadPool for downloading inventory ranges (created on first use)
+PEER_INV_DOWNLOAD_POOL_LOCK = threading.Lock()
 DB_LOCK = threading.Lock()
 
 def atlas_peer_table_lock():
@@ -267,7 +466,9 @@ def atlas_peer_table_lock():
         assert PEER_TABLE_LOCK_HOLDER != threading.current_thread(), "DEADLOCK"
         # log.warning("\n\nPossible contention: lock from %s (but held by %s at)\n%s\n\n" % (threading.current_thread(), PEER_TABLE_LOCK_HOLDER, PEER_TABLE_LOCK_TRACEBACK))
 
-    PEER_TABLE_LOCK.acquire()
+    assert not PEER_TABLE_LOCK.is_read_locked_by_me(), "DEADLOCK"
+
+    PEER_TABLE_LOCK.acquire_write()
     PEER_TABLE_LOCK_HOLDER = threading.current_thread()
     PEER_TABLE_LOCK_TRACEBACK = traceback.format_stack()
 
@@ -275,20 +476,52 @@ def atlas_peer_table_lock():
     return PEER_TABLE
 
 
+def atlas_peer_table_rlock():
+    """
+    Lock the global health info table for reading.
+    Other readers can hold it at the same time, so
+    don't modify the table (or its peers' inventories)
+    while holding this lock.
+    Return the table.
+    """
+    global PEER_TABLE_LOCK, PEER_TABLE, PEER_TABLE_LOCK_HOLDER
+
+    assert PEER_TABLE_LOCK_HOLDER != threading.current_thread(), "DEADLOCK"
+    assert not PEER_TABLE_LOCK.is_read_locked_by_me(), "DEADLOCK"
+
+    PEER_TABLE_LOCK.acquire_read()
+    return PEER_TABLE
+
+
+def atlas_peer_table_runlock():
+    """
+    Unlock the global health info table, after atlas_peer_table_rlock()
+    """
+    global PEER_TABLE_LOCK
+
+    if not PEER_TABLE_LOCK.is_read_locked_by_me():
+        log.error("Not read-locked by %s" % threading.current_thread())
+        log.error("Errant thread unlocked from:\n%s" % "".join(traceback.format_stack()))
+        os.abort()
+
+    PEER_TABLE_LOCK.release_read()
+    return
+
+
 def atlas_peer_table_is_locked():
     """
-    Is the peer table locked?
+    Is the peer table locked (for reading or writing)?
     """
-    global PEER_TABLE_LOCK_HOLDER
-    return (PEER_TABLE_LOCK_HOLDER is not None)
+    global PEER_TABLE_LOCK, PEER_TABLE_LOCK_HOLDER
+    return (PEER_TABLE_LOCK_HOLDER is not None or PEER_TABLE_LOCK.is_read_locked())
 
 
 def atlas_peer_table_is_locked_by_me():
     """
-    Is the peer table locked by the calling thread?
+    Is the peer table locked (for reading or writing) by the calling thread?
     """
-    global PEER_TABLE_LOCK_HOLDER
-    return (PEER_TABLE_LOCK_HOLDER == threading.current_thread())
+    global PEER_TABLE_LOCK, PEER_TABLE_LOCK_HOLDER
+    return (PEER_TABLE_LOCK_HOLDER == threading.current_thread() or PEER_TABLE_LOCK.is_read_locked_by_me())
 
 
 def atlas_peer_table_unlock():
@@ -308,7 +541,7 @@ def atlas_peer_table_unlock():
     # log.debug("\n\npeer table lock released by %s at \n%s\n\n" % (PEER_TABLE_LOCK_HOLDER, PEER_TABLE_LOCK_TRACEBACK))
     PEER_TABLE_LOCK_HOLDER = None
     PEER_TABLE_LOCK_TRACEBACK = None
-    PEER_TABLE_LOCK.release()
+    PEER_TABLE_LOCK.release_write()
     return
 
 
@@ -366,28 +599,40 @@ def atlas_inventory_flip_zonefile_bits( inv_vec, bit_indexes, operation ):
     If operation is True, then set the bits.
     If operation is False, then clear the bits
 
-    Return the new inv_vec
+    If inv_vec is a bytearray, it is modified in place.
+    Return the new inv_vec (as a bytearray if given a bytearray,
+    or as a string otherwise).
     """
-    inv_list = list(inv_vec)
+    if isinstance(inv_vec, bytearray):
+        inv_bytes = inv_vec
+    else:
+        inv_bytes = bytearray(inv_vec)
+
+    if len(bit_indexes) == 0:
+        return inv_vec
 
     max_byte_index = max(bit_indexes) / 8 + 1
-    if len(inv_list) <= max_byte_index:
-        inv_list += ['\0'] * (max_byte_index - len(inv_list))
+    if len(inv_bytes) <= max_byte_index:
+        inv_bytes.extend( '\0' * (max_byte_index - len(inv_bytes)) )
 
+    # coalesce bits into one mask per byte, so each byte is touched once
+    byte_masks = {}
     for bit_index in bit_indexes:
         byte_index = bit_index / 8
-        bit_index = 7 - (bit_index % 8)
-        
-        zfbits = ord(inv_list[byte_index])
+        byte_masks[byte_index] = byte_masks.get(byte_index, 0) | (1 << (7 - (bit_index % 8)))
 
-        if operation:
-            zfbits = zfbits | (1 << bit_index)
-        else:
-            zfbits = zfbits & ~(1 << bit_index)
+    if operation:
+        for byte_index, mask in byte_masks.iteritems():
+            inv_bytes[byte_index] |= mask
+
+    else:
+        for byte_index, mask in byte_masks.iteritems():
+            inv_bytes[byte_index] &= ~mask & 0xff
 
-        inv_list[byte_index] = chr(zfbits)
+    if inv_bytes is inv_vec:
+        return inv_bytes
 
-    return "".join(inv_list)
+    return str(inv_bytes)
 
 
 def atlas_inventory_set_zonefile_bits( inv_vec, bit_indexes ):
@@ -404,29 +649,75 @@ def atlas_inventory_clear_zonefile_bits( inv_vec, bit_indexes ):
     return atlas_inventory_flip_zonefile_bits( inv_vec, bit_indexes, False )
 
 
-def atlas_inventory_test_zonefile_bits( inv_vec, bit_indexes ):
+def atlas_inventory_bit_masks( bit_indexes ):
     """
-    Given a list of bit indexes (bit_indexes), determine whether or not 
-    they are set.
+    Given a list of bit indexes (bit_indexes), get the
+    (byte index, bit mask) pair for each one.
+
+    Use this to test the same bits against many inventory vectors
+    (see atlas_inventory_test_bit_masks).
+    """
+    return [(bit_index / 8, 1 << (7 - (bit_index % 8))) for bit_index in bit_indexes]
+
+
+def atlas_inventory_test_bit_masks( inv_vec, bit_masks ):
+    """
+    Given a list of (byte index, bit mask) pairs from 
+    atlas_inventory_bit_masks, determine whether or not 
+    they are set.  Bits beyond the end of inv_vec are treated as clear.
 
     Return True if all are set
     Return False if not
     """
-    inv_list = list(inv_vec)
+    inv_len = len(inv_vec)
+    is_bytes = isinstance(inv_vec, bytearray)
 
-    max_byte_index = max(bit_indexes) / 8 + 1
-    if len(inv_list) <= max_byte_index:
-        inv_list += ['\0'] * (max_byte_index - len(inv_list))
+    for (byte_index, bit_mask) in bit_masks:
+        if byte_index >= inv_len:
+            return False
 
-    ret = True
-    for bit_index in bit_indexes:
-        byte_index = bit_index / 8
-        bit_index = 7 - (bit_index % 8)
-        
-        zfbits = ord(inv_list[byte_index])
-        ret = (ret and ((zfbits & (1 << bit_index)) != 0))
+        zfbits = inv_vec[byte_index]
+        if not is_bytes:
+            zfbits = ord(zfbits)
+
+        if (zfbits & bit_mask) == 0:
+            return False
+
+    return True
+
+
+def atlas_inventory_test_zonefile_bit( inv_vec, bit_index ):
+    """
+    Determine whether or not a single bit is set.
+    Bits beyond the end of inv_vec are treated as clear.
+
+    Return True if set
+    Return False if not
+    """
+    byte_index = bit_index >> 3
+    if byte_index >= len(inv_vec):
+        return False
+
+    zfbits = inv_vec[byte_index]
+    if not isinstance(inv_vec, bytearray):
+        zfbits = ord(zfbits)
+
+    return ((zfbits >> (7 - (bit_index & 7))) & 1) != 0
 
-    return ret
+
+def atlas_inventory_test_zonefile_bits( inv_vec, bit_indexes ):
+    """
+    Given a list of bit indexes (bit_indexes), determine whether or not 
+    they are set.  Bits beyond the end of inv_vec are treated as clear.
+
+    Return True if all are set
+    Return False if not
+    """
+    if len(bit_indexes) == 1:
+        # common case: the zonefile occupies one bit
+        return atlas_inventory_test_zonefile_bit( inv_vec, bit_indexes[0] )
+
+    return atlas_inventory_test_bit_masks( inv_vec, atlas_inventory_bit_masks(bit_indexes) )
 
 
 def atlasdb_row_factory( cursor, row ):
@@ -482,6 +773,56 @@ def atlasdb_query_execute( cur, query, values ):
         os.abort()
 
 
+def atlasdb_query_executemany( cur, query, values_list ):
+    """
+    Execute a query once for each set of values.  If it fails, exit.
+
+    DO NOT CALL THIS DIRECTLY.
+    """
+
+    global DB_LOCK
+
+    try:
+        DB_LOCK.acquire()
+        ret = cur.executemany( query, values_list )
+        DB_LOCK.release()
+        return ret
+    except Exception, e:
+        log.exception(e)
+        log.error("FATAL: failed to execute query (%s, %s rows)" % (query, len(values_list)))
+        log.error("\n" + "\n".join(traceback.format_stack()))
+        os.abort()
+
+
+def atlasdb_configure( con ):
+    """
+    Set connection-level pragmas on an atlas db connection:
+    * use the write-ahead log, so the crawler threads' reads don't block on writes
+    * only fsync on checkpoints (WAL keeps the db consistent)
+    * wait on a locked db instead of failing immediately
+    * keep temporary tables and a larger page cache in RAM
+    """
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA busy_timeout=5000;")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute("PRAGMA cache_size=-65536;")
+    return con
+
+
+def atlasdb_create_indexes( con ):
+    """
+    Create the zonefile table indexes, if they don't exist yet.
+    """
+    global ATLASDB_INDEXES_SQL
+
+    lines = [l + ";" for l in ATLASDB_INDEXES_SQL.split(";")]
+    for line in lines:
+        con.execute(line)
+
+    return True
+
+
 def atlasdb_open( path ):
     """
     Open the atlas db.
@@ -492,8 +833,11 @@ def atlasdb_open( path ):
         log.debug("Atlas DB doesn't exist at %s" % path)
         return None
 
-    con = sqlite3.connect( path, isolation_level=None )
+    # all atlas queries use fixed SQL text with ? placeholders,
+    # so sqlite3's per-connection statement cache can reuse their compiled forms
+    con = sqlite3.connect( path, isolation_level=None, cached_statements=ATLASDB_CACHED_STATEMENTS )
     con.row_factory = atlasdb_row_factory
+    atlasdb_configure( con )
     return con
 
 
@@ -503,7 +847,7 @@ def atlasdb_add_zonefile_info( name, zonefile_hash, txid, present, block_height,
     Mark it as present or absent.
     Keep our in-RAM inventory vector up-to-date
     """
-    global ZONEFILE_INV, NUM_ZONEFILES
+    global ZONEFILE_INV, ZONEFILE_INV_GENERATION, NUM_ZONEFILES
 
     if path is None:
         path = atlasdb_path()
@@ -521,27 +865,63 @@ def atlasdb_add_zonefile_info( name, zonefile_hash, txid, present, block_height,
     update_res = atlasdb_query_execute( cur, sql, args )
     con.commit()
 
+    new_inv_index = None
     if update_res.rowcount == 0:
         sql = "INSERT OR IGNORE INTO zonefiles (name, zonefile_hash, txid, present, tried_storage, block_height) VALUES (?,?,?,?,?,?);"
         args = (name, zonefile_hash, txid, present, 0, block_height)
     
         cur = con.cursor()
-        atlasdb_query_execute( cur, sql, args )
+        insert_res = atlasdb_query_execute( cur, sql, args )
         con.commit()
 
-    # keep in-RAM zonefile inv coherent
-    zfbits = atlasdb_get_zonefile_bits( zonefile_hash, con=con, path=path )
+        if insert_res.rowcount == 1:
+            # inv_index is the rowid
+            new_inv_index = insert_res.lastrowid
 
-    inv_vec = None
-    if ZONEFILE_INV is None:
-        inv_vec = ""
+            # this hash has a new bit
+            atlasdb_zonefile_bits_cache_invalidate( path, zonefile_hash=zonefile_hash )
+
+    else:
+        # the row may have moved from another zonefile hash
+        atlasdb_zonefile_bits_cache_invalidate( path )
+
+    # the row we just wrote
+    if new_inv_index is not None:
+        zfrow = {
+            'inv_index': new_inv_index,
+            'name': name,
+            'zonefile_hash': zonefile_hash,
+            'txid': txid,
+            'present': True if present else False,
+            'tried_storage': False,
+            'block_height': block_height
+        }
     else:
-        inv_vec = ZONEFILE_INV[:]
+        zfrow = atlasdb_find_zonefile_by_txid( txid, con=con, path=path )
+
+    # keep in-RAM zonefile inv coherent.
+    # only this txid's row changed, even if other rows share its zonefile hash.
+    zfbits = []
+    if zfrow is not None:
+        # NOTE: zero-indexed
+        zfbits = [zfrow['inv_index'] - 1]
 
-    ZONEFILE_INV = atlas_inventory_flip_zonefile_bits( inv_vec, zfbits, present )
+    if ZONEFILE_INV is None:
+        ZONEFILE_INV = bytearray()
+
+    # flipped in place; no need to copy the whole vector
+    atlas_inventory_flip_zonefile_bits( ZONEFILE_INV, zfbits, present )
+    ZONEFILE_INV_GENERATION += 1
 
     # keep in-RAM zonefile count coherent
-    NUM_ZONEFILES = atlasdb_zonefile_inv_length( con=con, path=path )
+    if new_inv_index is not None:
+        NUM_ZONEFILES = max(NUM_ZONEFILES, new_inv_index)
+    else:
+        NUM_ZONEFILES = atlasdb_zonefile_inv_length( con=con, path=path )
+
+    # keep in-RAM missing zonefile set coherent
+    if zfrow is not None:
+        atlas_missing_zonefiles_put( zfrow )
 
     if close:
         con.close()
@@ -567,7 +947,6 @@ def atlasdb_get_lastblock( con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     row = {}
     for r in res:
@@ -600,7 +979,6 @@ def atlasdb_get_zonefile( zonefile_hash, con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     ret = {
         'zonefile_hash': zonefile_hash,
@@ -642,7 +1020,6 @@ def atlasdb_find_zonefile_by_txid( txid, con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     ret = None
     for zfinfo in res:
@@ -662,7 +1039,7 @@ def atlasdb_set_zonefile_present( zonefile_hash, present, con=None, path=None ):
     Keep our in-RAM zonefile inventory coherent.
     Return the previous state.
     """
-    global ZONEFILE_INV
+    global ZONEFILE_INV, ZONEFILE_INV_GENERATION
 
     if path is None:
         path = atlasdb_path()
@@ -687,17 +1064,28 @@ def atlasdb_set_zonefile_present( zonefile_hash, present, con=None, path=None ):
 
     zfbits = atlasdb_get_zonefile_bits( zonefile_hash, con=con, path=path )
     
-    inv_vec = None
     if ZONEFILE_INV is None:
-        inv_vec = ""
-    else:
-        inv_vec = ZONEFILE_INV[:]
+        ZONEFILE_INV = bytearray()
 
     # did we know about this?
-    was_present = atlas_inventory_test_zonefile_bits( inv_vec, zfbits )
+    was_present = atlas_inventory_test_zonefile_bits( ZONEFILE_INV, zfbits )
+
+    # keep our inventory vector coherent (flipped in place).
+    atlas_inventory_flip_zonefile_bits( ZONEFILE_INV, zfbits, present )
+    ZONEFILE_INV_GENERATION += 1
+
+    # keep our missing zonefile set coherent
+    if present:
+        atlas_missing_zonefiles_remove( [zfbit + 1 for zfbit in zfbits] )
 
-    # keep our inventory vector coherent.
-    ZONEFILE_INV = atlas_inventory_flip_zonefile_bits( inv_vec, zfbits, present )
+    else:
+        sql = "SELECT * FROM zonefiles WHERE zonefile_hash = ?;"
+        args = (zonefile_hash,)
+
+        cur = con.cursor()
+        res = atlasdb_query_execute( cur, sql, args )
+        for zfrow in res.fetchall():
+            atlas_missing_zonefiles_put( zfrow )
 
     if close:
         con.close()
@@ -732,6 +1120,10 @@ def atlasdb_set_zonefile_tried_storage( zonefile_hash, tried_storage, con=None,
     res = atlasdb_query_execute( cur, sql, args )
 
     con.commit()
+
+    zfbits = atlasdb_get_zonefile_bits( zonefile_hash, con=con, path=path )
+    atlas_missing_zonefiles_set_tried_storage( [zfbit + 1 for zfbit in zfbits], (tried_storage == 1) )
+
     if close:
         con.close()
 
@@ -759,6 +1151,10 @@ def atlasdb_reset_zonefile_tried_storage( con=None, path=None ):
     res = atlasdb_query_execute( cur, sql, args )
 
     con.commit()
+
+    # all missing zonefiles
+    atlas_missing_zonefiles_set_tried_storage( None, False )
+
     if close:
         con.close()
 
@@ -769,24 +1165,158 @@ def atlasdb_cache_zonefile_info( con=None, path=None ):
     """
     Load up and cache our zonefile inventory
     """
-    global ZONEFILE_INV, NUM_ZONEFILES
+    global ZONEFILE_INV, ZONEFILE_INV_GENERATION, NUM_ZONEFILES
 
     inv_len = atlasdb_zonefile_inv_length( con=con, path=path )
     inv = atlas_make_zonefile_inventory( 0, inv_len, con=con, path=path )
 
-    ZONEFILE_INV = inv
+    ZONEFILE_INV = bytearray(inv)
+    ZONEFILE_INV_GENERATION += 1
     NUM_ZONEFILES = inv_len
+
+    atlasdb_cache_missing_zonefiles( con=con, path=path )
     return inv
 
 
+def atlasdb_cache_missing_zonefiles( con=None, path=None ):
+    """
+    Load up and cache the set of zonefiles we don't have,
+    so the zonefile crawler doesn't have to go to the
+    database for them on each pass.
+    """
+    global MISSING_ZONEFILES, MISSING_ZONEFILES_LOCK
+
+    missing = {}
+    bit_offset = 0
+    bit_count = 10000
+
+    while True:
+        zfinfo = atlasdb_zonefile_find_missing( bit_offset, bit_count, con=con, path=path )
+        if len(zfinfo) == 0:
+            break
+
+        for zfrow in zfinfo:
+            missing[zfrow['inv_index']] = zfrow
+
+        # resume after the last missing zonefile's bit
+        bit_offset = zfinfo[-1]['inv_index']
+
+    with MISSING_ZONEFILES_LOCK:
+        MISSING_ZONEFILES = missing
+
+    return True
+
+
+def atlas_get_missing_zonefiles():
+    """
+    Get the cached list of zonefile rows that we don't have,
+    ordered by inv_index (i.e. what atlasdb_zonefile_find_missing() would return).
+    Return None if the cache isn't loaded.
+    """
+    global MISSING_ZONEFILES, MISSING_ZONEFILES_LOCK
+
+    with MISSING_ZONEFILES_LOCK:
+        if MISSING_ZONEFILES is None:
+            return None
+
+        inv_indexes = MISSING_ZONEFILES.keys()
+        inv_indexes.sort()
+        return [MISSING_ZONEFILES[inv_index] for inv_index in inv_indexes]
+
+
+def atlas_missing_zonefiles_put( zfrow ):
+    """
+    Keep the missing zonefile cache coherent with a zonefile row we just wrote.
+    Cached rows are never modified in place, so callers can iterate over
+    them without holding the lock.
+    """
+    global MISSING_ZONEFILES, MISSING_ZONEFILES_LOCK
+
+    with MISSING_ZONEFILES_LOCK:
+        if MISSING_ZONEFILES is None:
+            return
+
+        if zfrow['present']:
+            MISSING_ZONEFILES.pop( zfrow['inv_index'], None )
+        else:
+            MISSING_ZONEFILES[zfrow['inv_index']] = zfrow
+
+
+def atlas_missing_zonefiles_remove( inv_indexes ):
+    """
+    Remove zonefile rows from the missing zonefile cache (i.e. we got them)
+    """
+    global MISSING_ZONEFILES, MISSING_ZONEFILES_LOCK
+
+    with MISSING_ZONEFILES_LOCK:
+        if MISSING_ZONEFILES is None:
+            return
+
+        for inv_index in inv_indexes:
+            MISSING_ZONEFILES.pop( inv_index, None )
+
+
+def atlas_missing_zonefiles_set_tried_storage( inv_indexes, tried_storage ):
+    """
+    Update the tried_storage flag on cached missing zonefile rows.
+    If inv_indexes is None, update all of them.
+    """
+    global MISSING_ZONEFILES, MISSING_ZONEFILES_LOCK
+
+    with MISSING_ZONEFILES_LOCK:
+        if MISSING_ZONEFILES is None:
+            return
+
+        if inv_indexes is None:
+            inv_indexes = MISSING_ZONEFILES.keys()
+
+        for inv_index in inv_indexes:
+            zfrow = MISSING_ZONEFILES.get( inv_index, None )
+            if zfrow is None:
+                continue
+
+            # copy, so snapshots handed out by atlas_get_missing_zonefiles() don't change
+            zfrow = dict(zfrow)
+            zfrow['tried_storage'] = tried_storage
+            MISSING_ZONEFILES[inv_index] = zfrow
+
+
+def atlasdb_zonefile_bits_cache_invalidate( path, zonefile_hash=None ):
+    """
+    Forget the cached inventory bits for a zonefile hash
+    (or for all zonefile hashes, if zonefile_hash is None)
+    """
+    global ZONEFILE_BITS_CACHE, ZONEFILE_BITS_CACHE_LOCK
+
+    with ZONEFILE_BITS_CACHE_LOCK:
+        if zonefile_hash is None:
+            ZONEFILE_BITS_CACHE.clear()
+        else:
+            ZONEFILE_BITS_CACHE.pop( (path, zonefile_hash), None )
+
+    return True
+
+
 def atlasdb_get_zonefile_bits( zonefile_hash, con=None, path=None ):
     """
     What bit(s) in a zonefile inventory does a zonefile hash correspond to?
     Return their indexes in the bit field.
+
+    A zonefile's bits only change when a zonefile row is added or
+    rewritten, so the answer is cached until then.
     """
+    global ZONEFILE_BITS_CACHE, ZONEFILE_BITS_CACHE_MAX, ZONEFILE_BITS_CACHE_LOCK
+
     if path is None:
         path = atlasdb_path()
 
+    cache_key = (path, zonefile_hash)
+    with ZONEFILE_BITS_CACHE_LOCK:
+        cached = ZONEFILE_BITS_CACHE.get( cache_key, None )
+
+    if cached is not None:
+        return cached[:]
+
     close = False
     if con is None:
         close = True
@@ -798,7 +1328,6 @@ def atlasdb_get_zonefile_bits( zonefile_hash, con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     # NOTE: zero-indexed
     ret = []
@@ -808,16 +1337,40 @@ def atlasdb_get_zonefile_bits( zonefile_hash, con=None, path=None ):
     if close:
         con.close()
 
+    with ZONEFILE_BITS_CACHE_LOCK:
+        if len(ZONEFILE_BITS_CACHE) >= ZONEFILE_BITS_CACHE_MAX:
+            ZONEFILE_BITS_CACHE.clear()
+
+        ZONEFILE_BITS_CACHE[cache_key] = ret[:]
+
     return ret
 
 
 def atlasdb_queue_zonefiles( con, db, start_block, zonefile_dir=None, validate=True ):
     """
     Queue all zonefile hashes in the BlockstackDB
-    to the zonefile queue
+    to the zonefile queue.
+
+    All rows are written in a single transaction.  This does NOT
+    update the in-RAM zonefile inventory; the caller must call
+    atlasdb_cache_zonefile_info() afterwards.
     """
+    # txids we already have get updated, not inserted
+    # (an ignored insert can still consume an inv_index)
+    sql = "SELECT txid FROM zonefiles;"
+    args = ()
+
+    cur = con.cursor()
+    res = atlasdb_query_execute( cur, sql, args )
+    known_txids = set( [str(r['txid']) for r in res] )
+
+    # many names share the same zonefile (e.g. the default one),
+    # so only look for each distinct zonefile on disk once
+    zonefile_present = {}
+
     # populate zonefile queue
-    total = 0
+    update_rows = []
+    insert_rows = []
     for block_height in xrange(start_block, db.lastblock+1, 1):
 
         zonefile_info = db.get_atlas_zonefile_info_at( block_height )
@@ -826,11 +1379,39 @@ def atlasdb_queue_zonefiles( con, db, start_block, zonefile_dir=None, validate=T
             zfhash = str(name_txid_zfhash['value_hash'])
             txid = str(name_txid_zfhash['txid'])
 
-            present = is_zonefile_cached( zfhash, zonefile_dir=zonefile_dir, validate=validate ) 
+            present = zonefile_present.get(zfhash, None)
+            if present is None:
+                present = is_zonefile_cached( zfhash, zonefile_dir=zonefile_dir, validate=validate ) 
+                if present:
+                    present = 1
+                else:
+                    present = 0
+
+                zonefile_present[zfhash] = present
 
             log.debug("Add %s %s %s at %s (present: %s)" % (name, zfhash, txid, block_height, present) )
-            atlasdb_add_zonefile_info( name, zfhash, txid, present, block_height, con=con )
-            total += 1
+            if txid in known_txids:
+                update_rows.append( (name, zfhash, txid, present, 0, block_height, txid) )
+            else:
+                insert_rows.append( (name, zfhash, txid, present, 0, block_height) )
+                known_txids.add( txid )
+
+    total = len(update_rows) + len(insert_rows)
+    if total > 0:
+        # same end state as calling atlasdb_add_zonefile_info on each row,
+        # but with one commit for the whole range.
+        # new rows are inserted in order, so they get the same inv_index values.
+        insert_sql = "INSERT OR IGNORE INTO zonefiles (name, zonefile_hash, txid, present, tried_storage, block_height) VALUES (?,?,?,?,?,?);"
+        update_sql = "UPDATE zonefiles SET name = ?, zonefile_hash = ?, txid = ?, present = ?, tried_storage = ?, block_height = ? WHERE txid = ?;"
+
+        cur = con.cursor()
+        atlasdb_query_execute( cur, "BEGIN;", () )
+        atlasdb_query_executemany( cur, insert_sql, insert_rows )
+        atlasdb_query_executemany( cur, update_sql, update_rows )
+        atlasdb_query_execute( cur, "COMMIT;", () )
+
+        # zonefile bits changed wholesale
+        atlasdb_zonefile_bits_cache_invalidate( None )
 
     log.debug("Queued %s zonefiles from %s-%s" % (total, start_block, db.lastblock))
     return True
@@ -886,7 +1467,7 @@ def atlasdb_add_peer( peer_hostport, discovery_time=None, peer_table=None, con=N
         peer_table = atlas_peer_table_lock()
 
     # if the peer is already present, then abort
-    if peer_hostport in peer_table.keys():
+    if peer_hostport in peer_table:
         log.debug("%s already in the peer table" % peer_hostport)
 
         if locked:
@@ -921,11 +1502,10 @@ def atlasdb_add_peer( peer_hostport, discovery_time=None, peer_table=None, con=N
 
         cur = con.cursor()
         res = atlasdb_query_execute( cur, sql, args )
-        con.commit()
 
         old_hostports = []
         for row in res:
-            old_hostport = res['peer_hostport']
+            old_hostport = row['peer_hostport']
             old_hostports.append( old_hostport )
 
         for old_hostport in old_hostports:
@@ -999,7 +1579,7 @@ def atlasdb_remove_peer( peer_hostport, con=None, path=None, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_table.has_key(peer_hostport):
+    if peer_hostport in peer_table:
         if not atlas_peer_is_whitelisted( peer_hostport, peer_table=peer_table ) and not atlas_peer_is_blacklisted( peer_hostport, peer_table=peer_table ):
             del peer_table[peer_hostport]
 
@@ -1028,7 +1608,6 @@ def atlasdb_num_peers( con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     ret = []
     for row in res:
@@ -1091,7 +1670,6 @@ def atlasdb_get_random_peer( con=None, path=None ):
 
         cur = con.cursor()
         res = atlasdb_query_execute( cur, sql, args )
-        con.commit()
 
         ret = {'peer_hostport': None}
         for row in res:
@@ -1126,13 +1704,8 @@ def atlasdb_get_old_peers( now, con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
-    rows = []
-    for row in res:
-        tmp = {}
-        tmp.update(row)
-        rows.append(tmp)
+    rows = res.fetchall()
 
     if close:
         con.close()
@@ -1189,7 +1762,6 @@ def atlasdb_load_peer_table( con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     # build it up 
     count = 0
@@ -1232,6 +1804,9 @@ def atlasdb_init( path, db, peer_seeds, peer_blacklist, validate=False, zonefile
         if atlasdb_last_block is None:
             atlasdb_last_block = FIRST_BLOCK_MAINNET
 
+        # upgrade older databases
+        atlasdb_create_indexes( con )
+
         log.debug("Synchronize zonefiles from %s to %s" % (atlasdb_last_block, db.lastblock) )
 
         atlasdb_queue_zonefiles( con, db, atlasdb_last_block, validate=validate, zonefile_dir=zonefile_dir )
@@ -1257,7 +1832,8 @@ def atlasdb_init( path, db, peer_seeds, peer_blacklist, validate=False, zonefile
         log.debug("Initializing Atlas DB at %s" % path)
 
         lines = [l + ";" for l in ATLASDB_SQL.split(";")]
-        con = sqlite3.connect( path, isolation_level=None )
+        con = sqlite3.connect( path, isolation_level=None, cached_statements=ATLASDB_CACHED_STATEMENTS )
+        atlasdb_configure( con )
 
         for line in lines:
             con.execute(line)
@@ -1268,6 +1844,9 @@ def atlasdb_init( path, db, peer_seeds, peer_blacklist, validate=False, zonefile
         log.debug("Queuing all zonefiles")
         atlasdb_queue_zonefiles( con, db, FIRST_BLOCK_MAINNET, validate=validate, zonefile_dir=zonefile_dir )
 
+        # index once the bulk load is done, instead of on each insert
+        atlasdb_create_indexes( con )
+
         log.debug("Adding seed peers")
         for peer in peer_seeds:
             atlasdb_add_peer( peer, con=con, peer_table=peer_table )
@@ -1280,7 +1859,7 @@ def atlasdb_init( path, db, peer_seeds, peer_blacklist, validate=False, zonefile
         host, port = url_to_host_port( peer_url )
         peer_hostport = "%s:%s" % (host, port)
 
-        if peer_hostport not in peer_table.keys():
+        if peer_hostport not in peer_table:
             atlasdb_add_peer( peer_hostport, path=path, peer_table=peer_table )
 
         peer_table[peer_hostport]['whitelisted'] = True
@@ -1289,7 +1868,7 @@ def atlasdb_init( path, db, peer_seeds, peer_blacklist, validate=False, zonefile
         host, port = url_to_host_port( peer_url )
         peer_hostport = "%s:%s" % (host, port)
 
-        if peer_hostport not in peer_table.keys():
+        if peer_hostport not in peer_table:
             atlasdb_add_peer( peer_hostport, path=path, peer_table=peer_table )
         
         peer_table[peer_hostport]['blacklisted'] = True
@@ -1328,13 +1907,9 @@ def atlasdb_zonefile_inv_list( bit_offset, bit_length, con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
-    ret = []
-    for row in res:
-        tmp = {}
-        tmp.update(row)
-        ret.append(tmp)
+    # rows are already fresh dicts (see atlasdb_row_factory)
+    ret = res.fetchall()
 
     if close:
         con.close()
@@ -1360,7 +1935,6 @@ def atlasdb_zonefile_inv_length( con=None, path=None ):
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
     ret = []
     for row in res:
@@ -1391,8 +1965,9 @@ def atlasdb_zonefile_inv_length( con=None, path=None ):
 def atlasdb_zonefile_find_missing( bit_offset, bit_count, con=None, path=None ):
     """
     Find out which zonefiles we're still missing.
-    offset and count are *bit* indexes
-    Return a list of zonefile rows, where present == 0.
+    Scans forward from the zonefile at bit index bit_offset,
+    and returns at most bit_count rows.
+    Return a list of zonefile rows, where present == 0, ordered by inv_index.
     """
     if path is None:
         path = atlasdb_path()
@@ -1403,18 +1978,16 @@ def atlasdb_zonefile_find_missing( bit_offset, bit_count, con=None, path=None ):
         con = atlasdb_open( path )
         assert con is not None
 
-    sql = "SELECT * FROM zonefiles WHERE present = 0 LIMIT ? OFFSET ?;"
-    args = (bit_count, bit_offset)
+    # NOTE: inv_index is 1-indexed, so bit i is inv_index i+1.
+    # seek on the primary key instead of using OFFSET, so each page is O(page size)
+    sql = "SELECT * FROM zonefiles WHERE present = 0 AND inv_index > ? ORDER BY inv_index LIMIT ?;"
+    args = (bit_offset, bit_count)
 
     cur = con.cursor()
     res = atlasdb_query_execute( cur, sql, args )
-    con.commit()
 
-    ret = []
-    for row in res:
-        tmp = {}
-        tmp.update(row)
-        ret.append(tmp)
+    # rows are already fresh dicts (see atlasdb_row_factory)
+    ret = res.fetchall()
 
     if close:
         con.close()
@@ -1439,24 +2012,17 @@ def atlas_make_zonefile_inventory( bit_offset, bit_length, con=None, path=None )
     listing = atlasdb_zonefile_inv_list( bit_offset, bit_length, con=con, path=path )
 
     # serialize to inv
-    bool_vec = [l['present'] for l in listing]
-    if len(bool_vec) % 8 != 0: 
+    bit_str = "".join( ["1" if l['present'] else "0" for l in listing] )
+    if len(bit_str) == 0:
+        return ""
+
+    if len(bit_str) % 8 != 0: 
         # pad 
-        bool_vec += [False] * (8 - (len(bool_vec) % 8))
-
-    inv = ""
-    for i in xrange(0, len(bool_vec), 8):
-        bit_vec = map( lambda b: 1 if b else 0, bool_vec[i:i+8] )
-        next_byte = (bit_vec[0] << 7) | \
-                    (bit_vec[1] << 6) | \
-                    (bit_vec[2] << 5) | \
-                    (bit_vec[3] << 4) | \
-                    (bit_vec[4] << 3) | \
-                    (bit_vec[5] << 2) | \
-                    (bit_vec[6] << 1) | \
-                    (bit_vec[7])
-        inv += chr(next_byte)
+        bit_str += "0" * (8 - (len(bit_str) % 8))
 
+    # pack the bits in one shot
+    num_bytes = len(bit_str) / 8
+    inv = binascii.unhexlify( "%0*x" % (num_bytes * 2, int(bit_str, 2)) )
     return inv
 
 
@@ -1472,19 +2038,69 @@ def atlas_get_zonefile_inventory( offset=None, length=None ):
         log.error("FATAL: zonefile inventory not loaded")
         os.abort()
 
+    inv = ZONEFILE_INV
+    inv_len = len(inv)
+
     if offset is None:
         offset = 0
 
-    if length is None:
-        length = len(ZONEFILE_INV) - offset
+    if length is None:
+        length = inv_len - offset
+
+    if offset >= inv_len or length <= 0:
+        return ""
+
+    if offset + length > inv_len:
+        length = inv_len - offset
+        
+    # copy the window out exactly once.
+    # (a long-lived memoryview would pin the bytearray and break in-place resizing)
+    ret = str(buffer(inv, offset, length))
+    return ret
+
+
+def atlas_get_local_zonefile_inventory( con=None, path=None ):
+    """
+    Get our whole zonefile inventory vector.
+    Use the in-RAM copy (which is kept coherent with the db) if it's loaded,
+    and only rebuild it from the db if it isn't.
+    """
+    global ZONEFILE_INV
+
+    if ZONEFILE_INV is not None:
+        return atlas_get_zonefile_inventory()
+
+    inv_len = atlasdb_zonefile_inv_length( con=con, path=path )
+    return atlas_make_zonefile_inventory( 0, inv_len, con=con, path=path )
+
+
+def atlas_get_zonefile_inventory_b64( offset=None, length=None ):
+    """
+    Get a slice of the in-RAM zonefile inventory vector, base64-encoded
+    (i.e. for replying to RPC callers).
+    Encoded slices are cached until the inventory changes.
+    """
+    global ZONEFILE_INV_GENERATION, ZONEFILE_INV_B64_CACHE, ZONEFILE_INV_B64_CACHE_MAX
+
+    # NOTE: read the generation *before* the inventory, so a concurrent change
+    # can only cause us to cache a stale slice under a stale generation.
+    generation = ZONEFILE_INV_GENERATION
+    cache_generation, cache = ZONEFILE_INV_B64_CACHE
+    if cache_generation != generation:
+        cache = {}
+        ZONEFILE_INV_B64_CACHE = (generation, cache)
+
+    cache_key = (offset, length)
+    ret = cache.get(cache_key, None)
+    if ret is not None:
+        return ret
+
+    ret = base64.b64encode( atlas_get_zonefile_inventory( offset=offset, length=length ) )
 
-    if offset >= len(ZONEFILE_INV):
-        return ""
+    if len(cache) >= ZONEFILE_INV_B64_CACHE_MAX:
+        cache.clear()
 
-    if offset + length > len(ZONEFILE_INV):
-        length = len(ZONEFILE_INV) - offset
-        
-    ret = ZONEFILE_INV[offset:offset+length]
+    cache[cache_key] = ret
     return ret
 
 
@@ -1501,8 +2117,13 @@ def atlas_init_peer_info( peer_table, peer_hostport, blacklisted=False, whitelis
     Initialize peer info table entry
     """
     peer_table[peer_hostport] = {
-        "time": [],
+        "time": collections.deque(),     # (time, received_response) pairs, oldest first
+        "num_requests": 0,               # len(time)
+        "num_responses": 0,              # number of entries in time with received_response set
+        "lock": threading.Lock(),        # guards time, num_requests, num_responses, and availability_cache
         "zonefile_inv": "",
+        "zonefile_inv_version": 0,       # incremented whenever zonefile_inv is replaced
+        "availability_cache": None,      # (zonefile_inv_version, zonefile_inv length, ZONEFILE_INV_GENERATION, availability score)
         "blacklisted": blacklisted,
         "whitelisted": whitelisted
     }
@@ -1547,9 +2168,7 @@ def atlas_peer_ping( peer_hostport, timeout=None, peer_table=None ):
 
     assert not atlas_peer_table_is_locked_by_me()
 
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout )
 
     log.debug("Ping %s" % peer_hostport)
 
@@ -1560,6 +2179,7 @@ def atlas_peer_ping( peer_hostport, timeout=None, peer_table=None ):
             ret = True
 
     except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+        atlas_peer_rpc_client_evict( peer_hostport )
         atlas_log_socket_error( "ping(%s)" % peer_hostport, peer_hostport, se )
         pass
 
@@ -1573,7 +2193,7 @@ def atlas_peer_ping( peer_hostport, timeout=None, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_table.has_key(peer_hostport):
+    if peer_hostport in peer_table:
         atlas_peer_update_health( peer_hostport, ret, peer_table=peer_table )
 
     if locked:
@@ -1593,9 +2213,7 @@ def atlas_peer_getinfo( peer_hostport, timeout=None, peer_table=None ):
     if timeout is None:
         timeout = atlas_ping_timeout()
 
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout )
 
     assert not atlas_peer_table_is_locked_by_me()
 
@@ -1609,6 +2227,7 @@ def atlas_peer_getinfo( peer_hostport, timeout=None, peer_table=None ):
             res = None
                 
     except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+        atlas_peer_rpc_client_evict( peer_hostport )
         atlas_log_socket_error( "getinfo(%s)" % peer_hostport, peer_hostport, se )
 
     except AssertionError, ae:
@@ -1625,7 +2244,7 @@ def atlas_peer_getinfo( peer_hostport, timeout=None, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_table.has_key(peer_hostport):
+    if peer_hostport in peer_table:
         atlas_peer_update_health( peer_hostport, (res is not None), peer_table=peer_table )
 
     if locked:
@@ -1643,16 +2262,16 @@ def atlas_inventory_count_missing( inv1, inv2 ):
     """
     count = 0
     common = min(len(inv1), len(inv2))
-    for i in xrange(0, common):
-        for j in xrange(0, 8):
-            if ((1 << (7 - j)) & ord(inv2[i])) != 0 and ((1 << (7 - j)) & ord(inv1[i])) == 0:
-                count += 1
+    if common > 0:
+        # inv2 AND NOT inv1 over the common prefix, as one big integer
+        bits1 = int(binascii.hexlify(inv1[:common]), 16)
+        bits2 = int(binascii.hexlify(inv2[:common]), 16)
+        count = bin(bits2 & ~bits1).count("1")
 
     if len(inv1) < len(inv2):
-        for i in xrange(len(inv1), len(inv2)):
-            for j in xrange(0, 8):
-                if ((1 << (7 - j)) & ord(inv2[i])) != 0:
-                    count += 1
+        # every bit set in inv2's tail is missing from inv1
+        tail = binascii.hexlify(inv2[len(inv1):])
+        count += bin(int(tail, 16)).count("1")
 
     return count
 
@@ -1666,27 +2285,39 @@ def atlas_get_live_neighbors( remote_peer_hostport, peer_table=None, min_health=
     locked = False
     if peer_table is None:
         locked = True
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
-    alive_peers = []
+    # snapshot request counts under the lock, and score them outside of it
+    peer_counts = []
     for peer_hostport in peer_table.keys():
         if peer_hostport == remote_peer_hostport:
             continue
 
-        num_reqs = atlas_peer_get_request_count( peer_hostport, peer_table=peer_table )
-        if num_reqs < min_request_count:
+        peer_info = peer_table[peer_hostport]
+        peer_info['lock'].acquire()
+        peer_counts.append( (peer_hostport, peer_info['num_requests'], peer_info['num_responses']) )
+        peer_info['lock'].release()
+
+    if locked:
+        atlas_peer_table_runlock()
+        peer_table = None
+
+    alive_peers = []
+    for (peer_hostport, num_requests, num_responses) in peer_counts:
+
+        # same as atlas_peer_get_request_count and atlas_peer_get_health
+        if num_responses < min_request_count:
             continue
 
-        health = atlas_peer_get_health( peer_hostport, peer_table=peer_table )
+        health = 0.0
+        if num_requests > 0:
+            health = float(num_responses) / float(num_requests)
+
         if health < min_health:
             continue
 
         alive_peers.append( peer_hostport )
 
-    if locked:
-        atlas_peer_table_unlock()
-        peer_table = None
-
     random.shuffle(alive_peers)
     return alive_peers
 
@@ -1705,17 +2336,31 @@ def atlas_get_all_neighbors( peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    ret = copy.deepcopy(peer_table)
+    # locks can't be copied, and neither they nor cached scores are meaningful to the caller
+    for peer_hostport in peer_table.keys():
+        peer_info = peer_table[peer_hostport]
+        peer_info['lock'].acquire()
+
+        peer_copy = {}
+        for (key, value) in peer_info.items():
+            if key not in ['lock', 'availability_cache']:
+                peer_copy[key] = copy.deepcopy(value)
+
+        peer_info['lock'].release()
+        ret[peer_hostport] = peer_copy
 
     if locked:
         atlas_peer_table_unlock()
         peer_table = None
 
-    # make zonefile inventories printable
+    # make zonefile inventories printable, and request times serializable
     for peer_hostport in ret.keys():
-        if ret[peer_hostport].has_key('zonefile_inv'):
+        if 'zonefile_inv' in ret[peer_hostport]:
             ret[peer_hostport]['zonefile_inv'] = atlas_inventory_to_string( ret[peer_hostport]['zonefile_inv'] )
 
+        if 'time' in ret[peer_hostport]:
+            ret[peer_hostport]['time'] = list(ret[peer_hostport]['time'])
+
     return ret
 
 
@@ -1763,11 +2408,12 @@ def atlas_peer_get_health( peer_hostport, peer_table=None ):
     # availability score: number of responses / number of requests
     num_responses = 0
     num_requests = 0
-    if peer_table.has_key(peer_hostport):
-        for (t, r) in peer_table[peer_hostport]['time']:
-            num_requests += 1
-            if r:
-                num_responses += 1
+    if peer_hostport in peer_table:
+        peer_info = peer_table[peer_hostport]
+        peer_info['lock'].acquire()
+        num_requests = peer_info['num_requests']
+        num_responses = peer_info['num_responses']
+        peer_info['lock'].release()
 
     availability_score = 0.0
     if num_requests > 0:
@@ -1789,17 +2435,17 @@ def atlas_peer_get_request_count( peer_hostport, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
 
         return 0
 
-    count = 0
-    for (t, r) in peer_table[peer_hostport]['time']:
-        if r:
-            count += 1
+    peer_info = peer_table[peer_hostport]
+    peer_info['lock'].acquire()
+    count = peer_info['num_responses']
+    peer_info['lock'].release()
 
     if locked:
         atlas_peer_table_unlock()
@@ -1818,7 +2464,7 @@ def atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -1843,7 +2489,7 @@ def atlas_peer_set_zonefile_inventory( peer_hostport, peer_inv, peer_table=None
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -1851,6 +2497,7 @@ def atlas_peer_set_zonefile_inventory( peer_hostport, peer_inv, peer_table=None
         return None 
 
     peer_table[peer_hostport]['zonefile_inv'] = peer_inv
+    peer_table[peer_hostport]['zonefile_inv_version'] += 1
 
     if locked:
         atlas_peer_table_unlock()
@@ -1868,7 +2515,7 @@ def atlas_peer_is_blacklisted( peer_hostport, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -1893,7 +2540,7 @@ def atlas_peer_is_whitelisted( peer_hostport, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -1924,30 +2571,38 @@ def atlas_peer_update_health( peer_hostport, received_response, peer_table=None
         locked = True 
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
-        if locked:
-            atlas_peer_table_unlock()
-            peer_table = None
+    peer_info = peer_table.get(peer_hostport, None)
+
+    # only need the table lock to find the peer;
+    # its health is guarded by its own lock
+    if locked:
+        atlas_peer_table_unlock()
+        peer_table = None
 
+    if peer_info is None:
         return False
 
     # record that we contacted this peer, and whether or not we useful info from it
     now = time_now()
 
-    # update timestamps; remove old data
-    new_times = []
-    for (t, r) in peer_table[peer_hostport]['time']:
-        if t + atlas_peer_lifetime_interval() < now:
-            continue
-        
-        new_times.append((t, r))
+    peer_info['lock'].acquire()
 
-    new_times.append((now, received_response))
-    peer_table[peer_hostport]['time'] = new_times
+    # update timestamps; remove old data.
+    # entries are appended in time order, so expired ones are at the front.
+    peer_times = peer_info['time']
+    expire_time = now - atlas_peer_lifetime_interval()
+    while len(peer_times) > 0 and peer_times[0][0] < expire_time:
+        (t, r) = peer_times.popleft()
+        peer_info['num_requests'] -= 1
+        if r:
+            peer_info['num_responses'] -= 1
 
-    if locked:
-        atlas_peer_table_unlock()
-        peer_table = None
+    peer_times.append((now, received_response))
+    peer_info['num_requests'] += 1
+    if received_response:
+        peer_info['num_responses'] += 1
+
+    peer_info['lock'].release()
 
     return True
 
@@ -1971,9 +2626,7 @@ def atlas_peer_get_zonefile_inventory_range( my_hostport, peer_hostport, bit_off
     zf_inv = {}
     zf_inv_list = None
     
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout, src=my_hostport )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout, src=my_hostport )
 
     assert not atlas_peer_table_is_locked_by_me()
 
@@ -1984,6 +2637,7 @@ def atlas_peer_get_zonefile_inventory_range( my_hostport, peer_hostport, bit_off
         zf_inv = blockstack_get_zonefile_inventory( peer_hostport, bit_offset, bit_count, timeout=timeout, my_hostport=my_hostport, proxy=rpc )
      
     except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+        atlas_peer_rpc_client_evict( peer_hostport )
         atlas_log_socket_error( "get_zonefile_inventory(%s, %s, %s)" % (peer_hostport, bit_offset, bit_count), peer_hostport, se )
         log.error("Failed to ask %s for zonefile inventory over %s-%s (socket-related error)" % (peer_hostport, bit_offset, bit_count))
         
@@ -1993,7 +2647,7 @@ def atlas_peer_get_zonefile_inventory_range( my_hostport, peer_hostport, bit_off
 
         log.error("Failed to ask %s for zonefile inventory over %s-%s" % (peer_hostport, bit_offset, bit_count))
 
-    atlas_peer_update_health( peer_hostport, (zf_inv is not None and zf_inv.has_key('status') and zf_inv['status']), peer_table=peer_table )
+    atlas_peer_update_health( peer_hostport, (zf_inv is not None and 'status' in zf_inv and zf_inv['status']), peer_table=peer_table )
 
     if zf_inv is None:
         log.error("No inventory given for %s-%s from %s" % (bit_offset, bit_count, peer_hostport))
@@ -2034,21 +2688,74 @@ def atlas_peer_download_zonefile_inventory( my_hostport, peer_hostport, maxlen,
         # synced already
         return peer_inv
 
-    for offset in xrange( bit_offset, maxlen, interval):
-        next_inv = atlas_peer_get_zonefile_inventory_range( my_hostport, peer_hostport, offset, interval, timeout=timeout, peer_table=peer_table )
-        if next_inv is None:
-            # partial failure
-            log.debug("Failed to sync inventory for %s from %s to %s" % (peer_hostport, offset, offset+interval))
-            break
+    offsets = range( bit_offset, maxlen, interval )
 
-        peer_inv += next_inv
-        if len(next_inv) < interval:
-            # end-of-interval
-            break
+    def fetch_inventory_range( offset ):
+        # health is recorded below, from this thread
+        return atlas_peer_get_zonefile_inventory_range( my_hostport, peer_hostport, offset, interval, timeout=timeout, peer_table={} )
+
+    # the first range usually holds the whole inventory, so fetch it alone.
+    # after that, fetch up to PEER_INV_DOWNLOAD_THREADS ranges at once.
+    # stop at the first failed or short range, like a sequential download would.
+    wave_size = 1
+    i = 0
+    done = False
+    while i < len(offsets) and not done:
+        wave = offsets[i:i+wave_size]
+        i += len(wave)
+
+        if len(wave) == 1:
+            inv_ranges = [fetch_inventory_range( wave[0] )]
+        else:
+            inv_ranges = atlas_inventory_download_pool().map( fetch_inventory_range, wave )
+
+        for (offset, next_inv) in zip(wave, inv_ranges):
+            atlas_peer_update_health( peer_hostport, (next_inv is not None), peer_table=peer_table )
+
+            if next_inv is None:
+                # partial failure
+                log.debug("Failed to sync inventory for %s from %s to %s" % (peer_hostport, offset, offset+interval))
+                done = True
+                break
+
+            peer_inv += next_inv
+            if len(next_inv) < interval:
+                # end-of-interval
+                done = True
+                break
+
+        wave_size = PEER_INV_DOWNLOAD_THREADS
 
     return peer_inv
 
 
+def atlas_inventory_download_pool():
+    """
+    Get the thread pool used to download ranges of peers' zonefile inventories.
+    It is created on first use, and shared by all callers.
+    """
+    global PEER_INV_DOWNLOAD_POOL, PEER_INV_DOWNLOAD_POOL_LOCK
+
+    with PEER_INV_DOWNLOAD_POOL_LOCK:
+        if PEER_INV_DOWNLOAD_POOL is None:
+            PEER_INV_DOWNLOAD_POOL = ThreadPool( PEER_INV_DOWNLOAD_THREADS )
+
+        return PEER_INV_DOWNLOAD_POOL
+
+
+def atlas_inventory_download_pool_close():
+    """
+    Shut down the inventory download thread pool, if it's running.
+    """
+    global PEER_INV_DOWNLOAD_POOL, PEER_INV_DOWNLOAD_POOL_LOCK
+
+    with PEER_INV_DOWNLOAD_POOL_LOCK:
+        if PEER_INV_DOWNLOAD_POOL is not None:
+            PEER_INV_DOWNLOAD_POOL.close()
+            PEER_INV_DOWNLOAD_POOL.join()
+            PEER_INV_DOWNLOAD_POOL = None
+
+
 
 def atlas_peer_sync_zonefile_inventory( my_hostport, peer_hostport, maxlen, timeout=None, peer_table=None ):
     """
@@ -2070,7 +2777,7 @@ def atlas_peer_sync_zonefile_inventory( my_hostport, peer_hostport, maxlen, time
         locked = True    
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -2095,7 +2802,7 @@ def atlas_peer_sync_zonefile_inventory( my_hostport, peer_hostport, maxlen, time
     if locked:
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -2138,8 +2845,7 @@ def atlas_peer_refresh_zonefile_inventory( my_hostport, peer_hostport, byte_offs
 
     if local_inv is None:
         # get local zonefile inv 
-        inv_len = atlasdb_zonefile_inv_length( con=con, path=path )
-        local_inv = atlas_make_zonefile_inventory( 0, inv_len, con=con, path=path )
+        local_inv = atlas_get_local_zonefile_inventory( con=con, path=path )
 
     maxlen = len(local_inv)
 
@@ -2148,7 +2854,7 @@ def atlas_peer_refresh_zonefile_inventory( my_hostport, peer_hostport, byte_offs
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -2168,7 +2874,7 @@ def atlas_peer_refresh_zonefile_inventory( my_hostport, peer_hostport, byte_offs
     if locked:
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -2206,7 +2912,7 @@ def atlas_peer_has_fresh_zonefile_inventory( peer_hostport, peer_table=None ):
         locked = True
         peer_table = atlas_peer_table_lock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
             atlas_peer_table_unlock()
             peer_table = None
@@ -2218,7 +2924,7 @@ def atlas_peer_has_fresh_zonefile_inventory( peer_hostport, peer_table=None ):
     peer_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
 
     # NOTE: zero-length or None peer inventory means the peer is simply dead, but we've pinged it
-    if  peer_table[peer_hostport].has_key('zonefile_inventory_last_refresh') and \
+    if  'zonefile_inventory_last_refresh' in peer_table[peer_hostport] and \
         peer_table[peer_hostport]['zonefile_inventory_last_refresh'] + atlas_peer_ping_interval() > now:
 
         fresh = True
@@ -2247,7 +2953,7 @@ def atlas_peer_set_zonefile_status( peer_hostport, zonefile_hash, present, zonef
         locked = True    
         peer_table = atlas_peer_table_lock()
 
-    if peer_table.has_key(peer_hostport):
+    if peer_hostport in peer_table:
         peer_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
         peer_inv = atlas_inventory_flip_zonefile_bits( peer_inv, zonefile_bits, present )
         atlas_peer_set_zonefile_inventory( peer_hostport, peer_inv, peer_table=peer_table )
@@ -2259,6 +2965,52 @@ def atlas_peer_set_zonefile_status( peer_hostport, zonefile_hash, present, zonef
     return
 
 
+def atlas_peer_set_zonefile_statuses( peer_hostport, updates, peer_table=None, con=None, path=None ):
+    """
+    Mark several zonefiles as being present or absent on a peer,
+    as if by calling atlas_peer_set_zonefile_status on each.
+
+    @updates is a list of (zonefile hash, zonefile bits, present) tuples,
+    where zonefile bits can be None to look them up.
+    If a bit is both set and cleared by @updates, it ends up cleared.
+
+    The peer's inventory vector is copied and stored back once,
+    no matter how many zonefiles change.
+    """
+    set_bits = []
+    clear_bits = []
+    for (zonefile_hash, zonefile_bits, present) in updates:
+        if zonefile_bits is None:
+            zonefile_bits = atlasdb_get_zonefile_bits( zonefile_hash, con=con, path=path )
+
+        if present:
+            set_bits += zonefile_bits
+        else:
+            clear_bits += zonefile_bits
+
+    if len(set_bits) == 0 and len(clear_bits) == 0:
+        return
+
+    locked = False
+    if peer_table is None:
+        locked = True    
+        peer_table = atlas_peer_table_lock()
+
+    if peer_hostport in peer_table:
+        peer_inv = bytearray( atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table ) )
+
+        # flipped in place
+        atlas_inventory_flip_zonefile_bits( peer_inv, set_bits, True )
+        atlas_inventory_flip_zonefile_bits( peer_inv, clear_bits, False )
+        atlas_peer_set_zonefile_inventory( peer_hostport, str(peer_inv), peer_table=peer_table )
+                
+    if locked:
+        atlas_peer_table_unlock()
+        peer_table = None
+
+    return
+
+
 def atlas_find_missing_zonefile_availability( peer_table=None, con=None, path=None, missing_zonefile_info=None ):
     """
     Find the set of missing zonefiles, as well as their popularity amongst 
@@ -2296,7 +3048,9 @@ def atlas_find_missing_zonefile_availability( peer_table=None, con=None, path=No
                 break
 
             missing += zfinfo
-            bit_offset += len(zfinfo)
+
+            # resume after the last missing zonefile's bit
+            bit_offset = zfinfo[-1]['inv_index']
 
         log.debug("Missing %s zonefiles" % len(missing))
 
@@ -2307,51 +3061,172 @@ def atlas_find_missing_zonefile_availability( peer_table=None, con=None, path=No
         # none!
         return ret
 
+    peer_invs = atlas_peer_inventory_snapshot( peer_table=peer_table )
+    return atlas_zonefile_availability( missing, peer_invs )
+
+
+def atlas_iter_missing_zonefile_availability( peer_table=None, con=None, path=None, missing_zonefile_info=None, page_size=10000 ):
+    """
+    Like atlas_find_missing_zonefile_availability, but work through
+    the missing zonefiles a page at a time and generate
+    (zonefile hash, availability info) pairs as we go,
+    so each page's bitmask stays small.
+
+    Peers' inventories are snapshotted once, when the first page is read.
+
+    NOTE: a zonefile hash whose rows fall on different pages
+    is generated once per page (with that page's names, indexes, and peers).
+    Use atlas_select_missing_zonefiles() to merge them back together.
+    """
+    peer_invs = None
+    bit_offset = 0
+    page_start = 0
+
+    while True:
+        if missing_zonefile_info is None:
+            page = atlasdb_zonefile_find_missing( bit_offset, page_size, con=con, path=path )
+            if len(page) > 0:
+                # resume after the last missing zonefile's bit
+                bit_offset = page[-1]['inv_index']
+
+        else:
+            page = missing_zonefile_info[page_start:page_start + page_size]
+            page_start += page_size
+
+        if len(page) == 0:
+            break
+
+        if peer_invs is None:
+            peer_invs = atlas_peer_inventory_snapshot( peer_table=peer_table )
+
+        for zfhash, zfinfo in atlas_zonefile_availability( page, peer_invs ).iteritems():
+            yield (zfhash, zfinfo)
+
+
+def atlas_select_missing_zonefiles( missing_zfinfo_stream, batch_size ):
+    """
+    Given the (zonefile hash, availability info) pairs generated by
+    atlas_iter_missing_zonefile_availability, pick the zonefiles
+    the zonefile crawler should go after next.
+
+    A zonefile hash whose rows span several pages is merged back into one
+    entry first, so its names and indexes are complete.  Zonefiles that no
+    peer has and that we already tried to get from storage are skipped,
+    since there is nothing more we can do for them until the next storage retry.
+    Of the rest, keep the batch_size rarest (ties broken by hash).
+
+    Return a dict structured like atlas_find_missing_zonefile_availability's.
+    """
+    merged_zfinfo = {}
+    for (zfhash, zfinfo) in missing_zfinfo_stream:
+        if zfhash not in merged_zfinfo:
+            merged_zfinfo[zfhash] = zfinfo
+            continue
+
+        # rows from another page
+        merged = merged_zfinfo[zfhash]
+        merged['names'] += zfinfo['names']
+        merged['indexes'] += zfinfo['indexes']
+        merged['tried_storage'] = zfinfo['tried_storage']
+        merged['peers'] = list(set(merged['peers'] + zfinfo['peers']))
+        merged['popularity'] = len(merged['peers'])
+
+    obtainable = [ (zfhash, zfinfo) for (zfhash, zfinfo) in merged_zfinfo.iteritems() if zfinfo['popularity'] > 0 or not zfinfo['tried_storage'] ]
+    if len(obtainable) > batch_size:
+        obtainable = heapq.nsmallest( batch_size, obtainable, key=lambda zf: (zf[1]['popularity'], zf[0]) )
+
+    return dict(obtainable)
+
+
+def atlas_peer_inventory_snapshot( peer_table=None ):
+    """
+    Snapshot the peers' zonefile inventories, so they can be examined
+    without holding the peer table lock.
+    Peers we have no inventory for are omitted.
+
+    Return a list of (peer hostport, inventory vector)
+    """
     locked = False
     if peer_table is None:
         locked = True
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
-    # do any other peers have this zonefile?
-    for zfinfo in missing:
-        popularity = 0
-        byte_index = (zfinfo['inv_index'] - 1) / 8
-        bit_index = 7 - ((zfinfo['inv_index'] - 1) % 8)
-        peers = []
+    peer_invs = []
+    for peer_hostport in peer_table.keys():
+        peer_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
+        if len(peer_inv) > 0:
+            peer_invs.append( (peer_hostport, peer_inv) )
+
+    if locked:
+        atlas_peer_table_runlock()
+        peer_table = None
+
+    return peer_invs
+
+
+def atlas_zonefile_availability( missing, peer_invs ):
+    """
+    Given a list of missing zonefile rows and a snapshot of peers' inventories
+    (from atlas_peer_inventory_snapshot), find out which peers have which zonefiles.
+
+    Return a dict structured like atlas_find_missing_zonefile_availability's.
+    """
+    ret = {}
+    if len(missing) == 0:
+        return ret
 
-        if not ret.has_key(zfinfo['zonefile_hash']):
+    # which zonefile(s) does each missing bit stand for?
+    missing_bits = {}
+    missing_mask = bytearray( (max([zfinfo['inv_index'] for zfinfo in missing]) + 7) / 8 )
+    for zfinfo in missing:
+        bit = zfinfo['inv_index'] - 1
+        if zfinfo['zonefile_hash'] not in ret:
             ret[zfinfo['zonefile_hash']] = {
                 'names': [],
                 'txid': zfinfo['txid'],
                 'indexes': [],
                 'popularity': 0,
-                'peers': [],
+                'peers': set([]),      # converted to a list below
                 'tried_storage': False
             }
 
-        for peer_hostport in peer_table.keys():
-            peer_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
-            if len(peer_inv) <= byte_index:
-                # too new for this peer
-                continue
+        ret[zfinfo['zonefile_hash']]['names'].append( zfinfo['name'] )
+        ret[zfinfo['zonefile_hash']]['indexes'].append( bit )
+        ret[zfinfo['zonefile_hash']]['tried_storage'] = zfinfo['tried_storage']
 
-            if (ord(peer_inv[byte_index]) & (1 << bit_index)) == 0:
-                # this peer doesn't have it
-                continue
+        if bit not in missing_bits:
+            missing_bits[bit] = []
 
-            if peer_hostport not in ret[zfinfo['zonefile_hash']]['peers']:
-                popularity += 1
-                peers.append( peer_hostport )
+        missing_bits[bit].append( zfinfo['zonefile_hash'] )
+        missing_mask[bit / 8] |= 1 << (7 - (bit % 8))
 
-        ret[zfinfo['zonefile_hash']]['names'].append( zfinfo['name'] )
-        ret[zfinfo['zonefile_hash']]['indexes'].append( zfinfo['inv_index']-1 )
-        ret[zfinfo['zonefile_hash']]['popularity'] += popularity
-        ret[zfinfo['zonefile_hash']]['peers'] += peers
-        ret[zfinfo['zonefile_hash']]['tried_storage'] = zfinfo['tried_storage']
+    # do any other peers have these zonefiles?
+    # AND each peer's inventory with the missing mask all at once,
+    # and only visit the bits that survive.
+    missing_mask_ints = {}      # map prefix length to missing_mask[:length], as an integer
+    for (peer_hostport, peer_inv) in peer_invs:
+        common = min(len(peer_inv), len(missing_mask))
+        if common not in missing_mask_ints:
+            missing_mask_ints[common] = int(binascii.hexlify(missing_mask[:common]), 16)
 
-    if locked:
-        atlas_peer_table_unlock()
-        peer_table = None
+        hits = int(binascii.hexlify(peer_inv[:common]), 16) & missing_mask_ints[common]
+        if hits == 0:
+            # this peer has none of them
+            continue
+
+        hit_bytes = binascii.unhexlify( "%0*x" % (common * 2, hits) )
+        for match in INVENTORY_NONZERO_BYTE_PATTERN.finditer( hit_bytes ):
+            byte_index = match.start()
+            hit_byte = ord(match.group())
+            for j in xrange(0, 8):
+                if hit_byte & (1 << (7 - j)):
+                    for zfhash in missing_bits[byte_index * 8 + j]:
+                        ret[zfhash]['peers'].add( peer_hostport )
+
+    for zfhash in ret.keys():
+        # popularity is the number of distinct peers with any of this zonefile's bits
+        ret[zfhash]['popularity'] = len(ret[zfhash]['peers'])
+        ret[zfhash]['peers'] = list(ret[zfhash]['peers'])
 
     return ret
 
@@ -2378,11 +3253,11 @@ def atlas_peer_has_zonefile( peer_hostport, zonefile_hash, zonefile_bits=None, c
     locked = False
     if peer_table is None:
         locked = True
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
-    if peer_hostport not in peer_table.keys():
+    if peer_hostport not in peer_table:
         if locked:
-            atlas_peer_table_unlock()
+            atlas_peer_table_runlock()
             peer_table = None
 
         return False
@@ -2390,7 +3265,7 @@ def atlas_peer_has_zonefile( peer_hostport, zonefile_hash, zonefile_bits=None, c
     zonefile_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
     
     if locked:
-        atlas_peer_table_unlock()
+        atlas_peer_table_runlock()
         peer_table = None
 
     res = atlas_inventory_test_zonefile_bits( zonefile_inv, bits )
@@ -2414,9 +3289,7 @@ def atlas_peer_get_neighbors( my_hostport, peer_hostport, timeout=None, peer_tab
 
     peer_list = None
 
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout, src=my_hostport )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout, src=my_hostport )
 
     # sane limits
     max_neighbors = atlas_max_neighbors()
@@ -2427,10 +3300,13 @@ def atlas_peer_get_neighbors( my_hostport, peer_hostport, timeout=None, peer_tab
         peer_list = blockstack_get_atlas_peers( peer_hostport, timeout=timeout, my_hostport=my_hostport, proxy=rpc )
 
     except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+        atlas_peer_rpc_client_evict( peer_hostport )
         atlas_log_socket_error( "get_atlas_peers(%s)" % peer_hostport, peer_hostport, se)
         log.error("Socket error in response from '%s'" % peer_hostport)
 
     except Exception, e:
+        # don't reuse a client in an unknown state
+        atlas_peer_rpc_client_evict( peer_hostport )
         if os.environ.get("BLOCKSTACK_DEBUG") == "1":
             log.exception(e)
         log.error("Failed to talk to '%s'" % peer_hostport)
@@ -2468,9 +3344,7 @@ def atlas_get_zonefiles( my_hostport, peer_hostport, zonefile_hashes, timeout=No
     zf_payload = None
     zonefile_datas = {}
 
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout, src=my_hostport )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout, src=my_hostport )
 
     assert not atlas_peer_table_is_locked_by_me()
 
@@ -2485,9 +3359,12 @@ def atlas_get_zonefiles( my_hostport, peer_hostport, zonefile_hashes, timeout=No
             zf_payload = blockstack_get_zonefiles( peer_hostport, zf_batch, timeout=timeout, my_hostport=my_hostport, proxy=rpc )
 
         except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+            atlas_peer_rpc_client_evict( peer_hostport )
             atlas_log_socket_error( "get_zonefiles(%s)" % peer_hostport, peer_hostport, se)
 
         except Exception, e:
+            # don't reuse a client in an unknown state
+            atlas_peer_rpc_client_evict( peer_hostport )
             if os.environ.get("BLOCKSTACK_DEBUG") is not None:
                 log.exception(e)
 
@@ -2500,7 +3377,7 @@ def atlas_get_zonefiles( my_hostport, peer_hostport, zonefile_hashes, timeout=No
             zonefile_datas = None
             break
 
-        if 'error' in zf_payload.keys():
+        if 'error' in zf_payload:
             log.error("Failed to fetch zonefile data from %s: %s" % (peer_hostport, zf_payload['error']))
             atlas_peer_update_health( peer_hostport, False, peer_table=peer_table )
 
@@ -2510,7 +3387,10 @@ def atlas_get_zonefiles( my_hostport, peer_hostport, zonefile_hashes, timeout=No
         # success!
         zonefile_datas.update( zf_payload['zonefiles'] )
 
-    atlas_peer_update_health( peer_hostport, True, peer_table=peer_table )
+    if zonefile_datas is not None:
+        # (failures were recorded above)
+        atlas_peer_update_health( peer_hostport, True, peer_table=peer_table )
+
     return zonefile_datas
 
 
@@ -2541,24 +3421,42 @@ def atlas_rank_peers_by_health( peer_list=None, peer_table=None, with_zero_reque
     locked = False
     if peer_table is None:
         locked = True    
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
     if peer_list is None:
-        peer_list = peer_table.keys()[:]
+        peer_list = list(peer_table)
 
-    peer_health_ranking = []    # (health score, peer hostport)
+    # snapshot request counts under the lock in one pass, and score them outside of it
+    peer_counts = []
     for peer_hostport in peer_list:
-        reqcount = atlas_peer_get_request_count( peer_hostport, peer_table=peer_table )
-        if reqcount == 0 and not with_zero_requests:
-            continue
+        num_requests = 0
+        num_responses = 0
+        peer_info = peer_table.get( peer_hostport, None )
+        if peer_info is not None:
+            peer_info['lock'].acquire()
+            num_requests = peer_info['num_requests']
+            num_responses = peer_info['num_responses']
+            peer_info['lock'].release()
+
+        peer_counts.append( (peer_hostport, num_requests, num_responses) )
 
-        health_score = atlas_peer_get_health( peer_hostport, peer_table=peer_table)
-        peer_health_ranking.append( (health_score, peer_hostport) )
-    
     if locked:
-        atlas_peer_table_unlock()
+        atlas_peer_table_runlock()
         peer_table = None
 
+    peer_health_ranking = []    # (health score, peer hostport)
+    for (peer_hostport, num_requests, num_responses) in peer_counts:
+
+        # same as atlas_peer_get_request_count and atlas_peer_get_health
+        if num_responses == 0 and not with_zero_requests:
+            continue
+
+        health_score = 0.0
+        if num_requests > 0:
+            health_score = float(num_responses) / float(num_requests)
+
+        peer_health_ranking.append( (health_score, peer_hostport) )
+
     # sort on health
     peer_health_ranking.sort()
     peer_health_ranking.reverse()
@@ -2578,19 +3476,27 @@ def atlas_rank_peers_by_data_availability( peer_list=None, peer_table=None, loca
 
     This is used to select neighbors.
     """
+    global ZONEFILE_INV, ZONEFILE_INV_GENERATION
 
     locked = False
     if peer_table is None:
         locked = True    
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
     if peer_list is None:
-        peer_list = peer_table.keys()[:]
+        peer_list = list(peer_table)
 
+    # cached scores are only valid against our in-RAM inventory, which is
+    # identified by its generation (a caller-given inventory is not cached).
+    # NOTE: read the generation *before* the inventory, so a concurrent change
+    # can only cause us to cache a stale score under a stale generation.
+    local_generation = None
     if local_inv is None:
+        if ZONEFILE_INV is not None:
+            local_generation = ZONEFILE_INV_GENERATION
+
         # what's my inventory?
-        inv_len = atlasdb_zonefile_inv_length( con=con, path=path )
-        local_inv = atlas_make_zonefile_inventory( 0, inv_len, con=con, path=path )
+        local_inv = atlas_get_local_zonefile_inventory( con=con, path=path )
 
     peer_availability_ranking = []    # (health score, peer hostport)
     for peer_hostport in peer_list:
@@ -2601,11 +3507,30 @@ def atlas_rank_peers_by_data_availability( peer_list=None, peer_table=None, loca
         if len(peer_inv) == 0:
             continue
 
-        availability_score = atlas_inventory_count_missing( local_inv, peer_inv )
+        # only recount if either inventory changed since the last ranking.
+        # we only hold the table's read lock, so the cache is guarded by the peer's own lock.
+        peer_info = peer_table[peer_hostport]
+        cache_key = (peer_info['zonefile_inv_version'], len(peer_inv), local_generation)
+
+        peer_info['lock'].acquire()
+        cached = peer_info['availability_cache']
+        peer_info['lock'].release()
+
+        if local_generation is not None and cached is not None and cached[:3] == cache_key:
+            availability_score = cached[3]
+
+        else:
+            availability_score = atlas_inventory_count_missing( local_inv, peer_inv )
+
+            if local_generation is not None:
+                peer_info['lock'].acquire()
+                peer_info['availability_cache'] = cache_key + (availability_score,)
+                peer_info['lock'].release()
+
         peer_availability_ranking.append( (availability_score, peer_hostport) )
     
     if locked:
-        atlas_peer_table_unlock()
+        atlas_peer_table_runlock()
         peer_table = None
 
     # sort on availability
@@ -2632,7 +3557,7 @@ def atlas_peer_enqueue( peer_hostport, peer_table=None, peer_queue=None, max_nei
         table_lock = True
         peer_table = atlas_peer_table_lock()
 
-    present = (peer_hostport in peer_table.keys())
+    present = (peer_hostport in peer_table)
 
     if table_lock:
         atlas_peer_table_unlock()
@@ -2674,7 +3599,7 @@ def atlas_peer_dequeue_all( peer_queue=None ):
 
     peers = []
     while len(peer_queue) > 0:
-        peers.append( peer_queue.pop(0) )
+        peers.append( peer_queue.popleft() )
 
     if peer_lock:
         atlas_peer_queue_unlock()
@@ -2697,17 +3622,27 @@ def atlas_zonefile_find_push_peers( zonefile_hash, peer_table=None, zonefile_bit
     table_locked = False
     if peer_table is None:
         table_locked = True
-        peer_table = atlas_peer_table_lock()
+        peer_table = atlas_peer_table_rlock()
 
     push_peers = []
-    for peer_hostport in peer_table.keys():
-        zonefile_inv = atlas_peer_get_zonefile_inventory( peer_hostport, peer_table=peer_table )
-        res = atlas_inventory_test_zonefile_bits( zonefile_inv, zonefile_bits )
-        if res:
-            push_peers.append( peer_hostport )
+    if len(zonefile_bits) == 1:
+        # common case: the zonefile occupies one bit
+        zonefile_bit = zonefile_bits[0]
+        for peer_hostport in peer_table.keys():
+            zonefile_inv = peer_table[peer_hostport]['zonefile_inv']
+            if not atlas_inventory_test_zonefile_bit( zonefile_inv, zonefile_bit ):
+                push_peers.append( peer_hostport )
+
+    else:
+        # same bits for every peer
+        zonefile_bit_masks = atlas_inventory_bit_masks( zonefile_bits )
+        for peer_hostport in peer_table.keys():
+            zonefile_inv = peer_table[peer_hostport]['zonefile_inv']
+            if not atlas_inventory_test_bit_masks( zonefile_inv, zonefile_bit_masks ):
+                push_peers.append( peer_hostport )
 
     if table_locked:
-        atlas_peer_table_unlock()
+        atlas_peer_table_runlock()
         peer_table = None
 
     return push_peers
@@ -2744,6 +3679,7 @@ def atlas_zonefile_push_enqueue( zonefile_hash, zonefile_data, peer_table=None,
 
         if len(zonefile_queue) < MAX_QUEUED_ZONEFILES: 
             zonefile_queue.append( {zonefile_hash: zonefile_data} )
+            ZONEFILE_QUEUE_WAKEUP.set()
             res = True
         
         if zonefile_queue_locked:
@@ -2768,7 +3704,7 @@ def atlas_zonefile_push_dequeue( zonefile_queue=None ):
 
     ret = None
     if len(zonefile_queue) > 0:
-        ret = zonefile_queue.pop(0)
+        ret = zonefile_queue.popleft()
 
     if zonefile_queue_locked:
         atlas_zonefile_queue_unlock()
@@ -2789,9 +3725,7 @@ def atlas_zonefile_push( my_hostport, peer_hostport, zonefile_dict, timeout=None
     zonefile_hash = blockstack_client.hash_zonefile( zonefile_dict )
     zonefile_data_b64 = base64.b64encode( zonefile_data )
 
-    host, port = url_to_host_port( peer_hostport )
-    RPC = get_rpc_client_class()
-    rpc = RPC( host, port, timeout=timeout, src=my_hostport )
+    rpc = atlas_peer_rpc_client( peer_hostport, timeout, src=my_hostport )
 
     status = False
 
@@ -2802,9 +3736,10 @@ def atlas_zonefile_push( my_hostport, peer_hostport, zonefile_dict, timeout=None
         if 'error' not in push_info:
             if push_info['saved'] == 1:
                 # woo!
-                saved = True
+                status = True
 
     except (socket.timeout, socket.gaierror, socket.herror, socket.error), se:
+        atlas_peer_rpc_client_evict( peer_hostport )
         atlas_log_socket_error( "put_zonefiles(%s)" % peer_hostport, peer_hostport, se)
     
     except AssertionError, ae:
@@ -2868,6 +3803,7 @@ class AtlasPeerCrawler( threading.Thread ):
     def __init__(self, my_hostname, my_portnum, path=None ):
         threading.Thread.__init__(self)
         self.running = False
+        self.wakeup = threading.Event()
         self.last_clean_time = 0
 
         if my_hostname in ['127.0.0.1', '::1']:
@@ -2944,6 +3880,7 @@ class AtlasPeerCrawler( threading.Thread ):
         added = []
         present = []
         filtered = []
+        current_peer_set = set(current_peers)
         while i < len(new_peers) and cnt < min(count, len(new_peers)):
             peer = self.canonical_peer( new_peers[i] )
             i += 1
@@ -2952,7 +3889,7 @@ class AtlasPeerCrawler( threading.Thread ):
                 filtered.append(peer)
                 continue
 
-            if peer in current_peers:
+            if peer in current_peer_set:
                 log.debug("%s is already known" % peer)
                 present.append(peer)
                 continue 
@@ -2966,7 +3903,7 @@ class AtlasPeerCrawler( threading.Thread ):
                 filtered.append(peer)
                 continue
 
-            if not res.has_key('server_version'):
+            if 'server_version' not in res:
                 # too old
                 filtered.append(peer)
                 continue
@@ -3037,7 +3974,7 @@ class AtlasPeerCrawler( threading.Thread ):
             log.debug("%s: current peer degree is 0" % (self.my_hostport))
             return error_ret
 
-        next_peer = current_peer_neighbors[ random.randint(0, len(current_peer_neighbors)-1) ]
+        next_peer = random.choice( current_peer_neighbors )
         next_peer_neighbors = self.get_neighbors( next_peer, con=con, path=path, peer_table=peer_table )
         if next_peer_neighbors is None or len(next_peer_neighbors) == 0:
             # walk failed, or nowhere to go
@@ -3055,7 +3992,7 @@ class AtlasPeerCrawler( threading.Thread ):
                 if next_peer in search:
                     search.remove(next_peer)
 
-                alt_peer = search[ random.randint(0, len(search)-1) ]
+                alt_peer = random.choice( search )
                 alt_peer_neighbors = self.get_neighbors( alt_peer, con=con, path=path, peer_table=peer_table )
                 if alt_peer_neighbors is None or len(alt_peer_neighbors) == 0:
                     # walk failed, or nowhere to go
@@ -3100,12 +4037,12 @@ class AtlasPeerCrawler( threading.Thread ):
         locked = False
         if peer_table is None:
             locked = True
-            peer_table = atlas_peer_table_lock()
+            peer_table = atlas_peer_table_rlock()
 
-        current_peers = peer_table.keys()[:]
+        current_peers = list(peer_table)
 
         if locked:
-            atlas_peer_table_unlock()
+            atlas_peer_table_runlock()
             peer_table = None
 
         return current_peers
@@ -3154,9 +4091,6 @@ class AtlasPeerCrawler( threading.Thread ):
         # only handle a few peers for now
         log.debug("Add at most %s new peers out of %s options" % (num_new_peers, len(new_peers)))
         added, present, filtered = self.add_new_peers( num_new_peers, new_peers, current_peers, con=con, path=path, peer_table=peer_table )
-        for peer in filtered:
-            if peer in new_peers:
-                new_peers.remove(peer)
 
         new_peers = self.canonical_new_peer_list( added )
 
@@ -3188,9 +4122,8 @@ class AtlasPeerCrawler( threading.Thread ):
         removed = self.remove_unhealthy_peers( num_to_remove, con=con, path=path, peer_table=peer_table )
 
         # if they're also in the new set, remove them there too
-        for peer in removed:
-            if peer in self.new_peers:
-                self.new_peers.remove(peer)
+        removed_set = set(removed)
+        self.new_peers = [peer for peer in self.new_peers if peer not in removed_set]
 
         return len(removed)
 
@@ -3231,7 +4164,7 @@ class AtlasPeerCrawler( threading.Thread ):
         # first, begin the walk if we haven't already 
         if self.current_peer is None and len(current_peers) > 0:
             
-            self.current_peer = current_peers[ random.randint(0,len(current_peers)-1) ]
+            self.current_peer = random.choice( current_peers )
             
             log.debug("%s: crawl %s" % (self.my_hostport, self.current_peer))
             peer_neighbors = self.get_neighbors( self.current_peer, peer_table=peer_table, path=path, con=con )
@@ -3288,9 +4221,8 @@ class AtlasPeerCrawler( threading.Thread ):
 
             if num_added == 0 and num_removed == 0 and t2 - t1 < PEER_CRAWL_NEIGHBOR_WORK_INTERVAL:
                 # take a break
-                deadline = time_now() + PEER_CRAWL_NEIGHBOR_WORK_INTERVAL - (t2 - t1)
-                while time_now() < deadline and self.running:
-                    time_sleep( self.my_hostport, self.__class__.__name__, 1.0 )
+                deadline = atlas_idle_deadline( PEER_CRAWL_NEIGHBOR_WORK_INTERVAL, t2 - t1 )
+                time_sleep_until( self.my_hostport, self.__class__.__name__, deadline, self.wakeup )
                 
                 if not self.running:
                     break
@@ -3298,6 +4230,7 @@ class AtlasPeerCrawler( threading.Thread ):
 
     def ask_join(self):
         self.running = False
+        self.wakeup.set()
 
 
 class AtlasHealthChecker( threading.Thread ):
@@ -3310,6 +4243,7 @@ class AtlasHealthChecker( threading.Thread ):
     def __init__(self, my_host, my_port, path=None):
         threading.Thread.__init__(self)
         self.running = False
+        self.wakeup = threading.Event()
         self.path = path
         self.hostport = "%s:%s" % (my_host, my_port)
         self.last_clean_time = 0
@@ -3333,29 +4267,27 @@ class AtlasHealthChecker( threading.Thread ):
         if path is None:
             path = self.path
 
-        peer_hostports = []
         stale_peers = []
 
         lock = False
         if peer_table is None:
             lock = True
-            peer_table = atlas_peer_table_lock()
-
-        num_peers = len(peer_table.keys())
-        peer_hostports = peer_table.keys()[:]
+            peer_table = atlas_peer_table_rlock()
 
         # who are we going to ping?
         # someone we haven't pinged in a while, chosen at random
-        for peer in peer_hostports:
+        for peer in peer_table:
             if not atlas_peer_has_fresh_zonefile_inventory( peer, peer_table=peer_table ):
                 # haven't talked to this peer in a while
                 stale_peers.append(peer)
                 log.debug("Peer %s has a stale zonefile inventory" % peer)
 
         if lock:
-            atlas_peer_table_unlock()
+            atlas_peer_table_runlock()
             peer_table = None
 
+        random.shuffle( stale_peers )
+
         if len(stale_peers) > 0:
             log.debug("Refresh zonefile inventories for %s peers" % len(stale_peers))
 
@@ -3382,9 +4314,8 @@ class AtlasHealthChecker( threading.Thread ):
 
             # don't go too fast 
             if t2 - t1 < PEER_HEALTH_NEIGHBOR_WORK_INTERVAL:
-                deadline = time_now() + PEER_HEALTH_NEIGHBOR_WORK_INTERVAL - (t2 - t1)
-                while time_now() < deadline and self.running:
-                    time_sleep( self.hostport, self.__class__.__name__, 1.0 )
+                deadline = atlas_idle_deadline( PEER_HEALTH_NEIGHBOR_WORK_INTERVAL, t2 - t1 )
+                time_sleep_until( self.hostport, self.__class__.__name__, deadline, self.wakeup )
 
                 if not self.running:
                     break
@@ -3392,6 +4323,7 @@ class AtlasHealthChecker( threading.Thread ):
 
     def ask_join(self):
         self.running = False
+        self.wakeup.set()
 
 
 class AtlasZonefileCrawler( threading.Thread ):
@@ -3408,10 +4340,61 @@ class AtlasZonefileCrawler( threading.Thread ):
         self.zonefile_storage_drivers = zonefile_storage_drivers
         self.zonefile_dir = zonefile_dir
         self.last_storage_reset = time_now()
+        self.fetch_pool = None
+        self.wakeup = threading.Event()
         if self.path is None:
             self.path = atlasdb_path()
 
 
+    def get_fetch_pool( self ):
+        """
+        Get the thread pool we use to fetch zonefiles from
+        several peers at once.  It is created once and reused
+        across steps.
+        """
+        if self.fetch_pool is None:
+            num_threads = PEER_ZONEFILE_FETCH_THREADS
+            if num_threads is None:
+                num_threads = atlas_max_neighbors()
+
+            self.fetch_pool = ThreadPool( max(1, num_threads) )
+
+        return self.fetch_pool
+
+
+    def close_fetch_pool( self ):
+        """
+        Shut down the zonefile fetch thread pool, if we have one
+        """
+        if self.fetch_pool is not None:
+            self.fetch_pool.close()
+            self.fetch_pool.join()
+            self.fetch_pool = None
+
+
+    def fetch_zonefiles( self, peer_requests ):
+        """
+        Given a dict mapping peer hostports to lists of zonefile hashes,
+        ask each peer for its zonefiles concurrently.
+        Does not update peer health; the caller does that.
+
+        Return a dict mapping each peer hostport to the dict of zonefiles
+        it returned (or None if the request failed).
+        """
+        peer_hostports = peer_requests.keys()
+
+        def fetch_peer_zonefiles( peer_hostport ):
+            # health is recorded by the caller, from its thread
+            return atlas_get_zonefiles( self.hostport, peer_hostport, peer_requests[peer_hostport], peer_table={} )
+
+        if len(peer_hostports) <= 1:
+            results = map( fetch_peer_zonefiles, peer_hostports )
+        else:
+            results = self.get_fetch_pool().map( fetch_peer_zonefiles, peer_hostports )
+
+        return dict( zip(peer_hostports, results) )
+
+
     def store_zonefile_data( self, name, fetched_zfhash, txid, zonefile_data, peer_hostport, con, path ):
         """
         Store the fetched zonefile (as a serialized string) to storage and cache it locally.
@@ -3532,7 +4515,7 @@ class AtlasZonefileCrawler( threading.Thread ):
         # which peers can serve each zonefile?
         for zfhash in missing_zfinfo.keys():
             for peer_hostport in peer_hostports:
-                if not zonefile_origins.has_key(peer_hostport):
+                if peer_hostport not in zonefile_origins:
                     zonefile_origins[peer_hostport] = []
 
                 if peer_hostport in missing_zfinfo[zfhash]['peers']:
@@ -3542,7 +4525,7 @@ class AtlasZonefileCrawler( threading.Thread ):
 
 
 
-    def step(self, path=None, peer_table=None):
+    def step(self, path=None, peer_table=None, con=None):
         """
         Run one step of this algorithm:
         * find the set of missing zonefiles
@@ -3567,19 +4550,23 @@ class AtlasZonefileCrawler( threading.Thread ):
 
         if peer_table is None:
             locked = True
-            peer_table = atlas_peer_table_lock()
+            peer_table = atlas_peer_table_rlock()
 
-        missing_zfinfo = atlas_find_missing_zonefile_availability( peer_table=peer_table, path=path )
-        peer_hostports = peer_table.keys()[:]
+        peer_hostports = list(peer_table)
 
         if locked:
-            atlas_peer_table_unlock()
+            atlas_peer_table_runlock()
             peer_table = None
 
+        # work on a batch of the rarest zonefiles we can still get.
+        # use the in-RAM missing zonefile set if we have it.
+        missing_zfinfo_stream = atlas_iter_missing_zonefile_availability( peer_table=peer_table, con=con, path=path, missing_zonefile_info=atlas_get_missing_zonefiles() )
+        missing_zfinfo = atlas_select_missing_zonefiles( missing_zfinfo_stream, PEER_CRAWL_ZONEFILE_BATCH_SIZE )
+
         # ask for zonefiles in rarest-first order
         zonefile_ranking = [ (missing_zfinfo[zfhash]['popularity'], zfhash) for zfhash in missing_zfinfo.keys() ]
         zonefile_ranking.sort()
-        zonefile_hashes = list(set([zfhash for (_, zfhash) in zonefile_ranking]))
+        zonefile_hashes = [zfhash for (_, zfhash) in zonefile_ranking]
         zonefile_names = dict([(zfhash, missing_zfinfo[zfhash]['names']) for zfhash in zonefile_hashes])
         zonefile_txids = dict([(zfhash, missing_zfinfo[zfhash]['txid']) for zfhash in zonefile_hashes])
         zonefile_origins = self.find_zonefile_origins( missing_zfinfo, peer_hostports )
@@ -3597,31 +4584,30 @@ class AtlasZonefileCrawler( threading.Thread ):
 
         log.debug("%s: missing %s unique zonefiles" % (self.hostport, len(zonefile_hashes)))
 
-        while len(zonefile_hashes) > 0:
+        # first, try storage for the ones we haven't tried yet
+        remaining_zfhashes = []
+        for zfhash in zonefile_hashes:
 
-            zfhash = zonefile_hashes[0]
-            zfnames = zonefile_names[zfhash]
             zftxid = zonefile_txids[zfhash]
             peers = missing_zfinfo[zfhash]['peers']
 
-            zfinfo = atlasdb_find_zonefile_by_txid( zftxid, path=path )
-            if zfinfo is None:
-                # not known to us
-                log.warn("%s: unknown zonefile %s" % (self.hostport, zfhash))
+            if not missing_zfinfo[zfhash]['tried_storage']:
 
-            zfname = zfinfo['name']
+                zfinfo = atlasdb_find_zonefile_by_txid( zftxid, path=path, con=con )
+                if zfinfo is None:
+                    # not known to us
+                    log.warn("%s: unknown zonefile %s" % (self.hostport, zfhash))
+                    continue
+
+                zfname = zfinfo['name']
 
-            # is this zonefile available via storage?
-            if not missing_zfinfo[zfhash]['tried_storage']:
-                
                 # this can be somewhat memory-intensive, so
                 # invoke the gc immediately afterwards
-                rc = self.try_crawl_storage( zfname, zfhash, zftxid, path )
+                rc = self.try_crawl_storage( zfname, zfhash, zftxid, path, con=con )
                 gc.collect(2)
 
                 if rc:
                     # don't ask for it again
-                    zonefile_hashes.pop(0)
                     num_fetched += 1
                     continue
 
@@ -3630,67 +4616,90 @@ class AtlasZonefileCrawler( threading.Thread ):
                 if not missing_zfinfo[zfhash]['tried_storage']:
                     log.debug("%s: zonefile %s is unavailable" % (self.hostport, zfhash))
 
-                zonefile_hashes.pop(0)
                 continue
 
-            # try this zonefile's hosts in order by perceived availability
-            peers = atlas_rank_peers_by_health( peer_list=peers, with_zero_requests=True )
-            log.debug("%s: zonefile %s available from %s peers (%s...)" % (self.hostport, zfhash, len(peers), ",".join(peers[:min(5, len(peers))])))
+            remaining_zfhashes.append( zfhash )
 
-            for peer_hostport in peers:
+        # then, go get the rest from our peers.
+        # each round, ask each zonefile's healthiest untried peer for it
+        # (batching all zonefiles bound for the same peer), and query
+        # all such peers at once.
+        while len(remaining_zfhashes) > 0:
 
-                if zfhash not in zonefile_origins[peer_hostport]:
-                    # not available
-                    log.debug("%s not available from %s" % (zfhash, peer_hostport))
-                    continue
+            peer_order = atlas_rank_peers_by_health( peer_list=peer_hostports, peer_table=peer_table, with_zero_requests=True )
+            peer_requests = {}
+            next_zfhashes = []
 
-                # what other zonefiles can we get?
-                # only ask for the ones we don't have
-                peer_zonefile_hashes = []
-                for zfh in zonefile_origins[peer_hostport]:
-                    if zfh in zonefile_hashes:
-                        # can ask for this one too
-                        peer_zonefile_hashes.append( zfh )
+            for zfhash in remaining_zfhashes:
+                for peer_hostport in peer_order:
+                    if zfhash in zonefile_origins[peer_hostport]:
+                        if peer_hostport not in peer_requests:
+                            peer_requests[peer_hostport] = []
 
-                if len(peer_zonefile_hashes) == 0:
-                    log.debug("%s: No zonefiles available from %s" % (self.hostport, peer_hostport))
-                    continue
+                        peer_requests[peer_hostport].append( zfhash )
+                        next_zfhashes.append( zfhash )
+                        break
+
+                else:
+                    log.debug("%s: zonefile %s is not available from any remaining peer" % (self.hostport, zfhash))
+
+            if len(peer_requests) == 0:
+                break
 
-                # get them all
-                log.debug("%s: get %s zonefiles from %s" % (self.hostport, len(peer_zonefile_hashes), peer_hostport))
-                zonefiles = atlas_get_zonefiles( self.hostport, peer_hostport, peer_zonefile_hashes, peer_table=peer_table )
+            for peer_hostport in peer_requests.keys():
+                log.debug("%s: get %s zonefiles from %s" % (self.hostport, len(peer_requests[peer_hostport]), peer_hostport))
+
+            peer_zonefiles = self.fetch_zonefiles( peer_requests )
+
+            # store what we got, and find out what each peer didn't have
+            fetched_zfhashes = set([])
+            missing_peer_zfhashes = {}
+            for peer_hostport in peer_requests.keys():
+
+                peer_zonefile_hashes = peer_requests[peer_hostport][:]
+                zonefiles = peer_zonefiles[peer_hostport]
                 if zonefiles is not None:
 
                     # got zonefiles!
-                    stored_zfhashes = self.store_zonefiles( zonefile_names, zonefiles, zonefile_txids, peer_zonefile_hashes, peer_hostport, path )
-                    
+                    stored_zfhashes = self.store_zonefiles( zonefile_names, zonefiles, zonefile_txids, peer_zonefile_hashes, peer_hostport, path, con=con )
+
                     # don't ask again
                     log.debug("Stored %s zonefiles" % len(stored_zfhashes))
                     for zfh in stored_zfhashes:
                         peer_zonefile_hashes.remove(zfh)
-                        num_fetched += 1
-                
+                        if zfh not in fetched_zfhashes:
+                            fetched_zfhashes.add( zfh )
+                            num_fetched += 1
+
                 else:
                     log.debug("%s: no data received from %s" % (self.hostport, peer_hostport))
 
-                if locked:
-                    peer_table = atlas_peer_table_lock()
+                missing_peer_zfhashes[peer_hostport] = peer_zonefile_hashes
+
+            if locked:
+                peer_table = atlas_peer_table_lock()
 
-                # if the node didn't actually have these zonefiles, then 
+            for peer_hostport in peer_requests.keys():
+                atlas_peer_update_health( peer_hostport, (peer_zonefiles[peer_hostport] is not None), peer_table=peer_table )
+
+                # if the node didn't actually have these zonefiles, then
                 # update their inventories so we don't ask for them again.
-                for zfh in peer_zonefile_hashes:
+                status_updates = []
+                for zfh in missing_peer_zfhashes[peer_hostport]:
                     log.debug("%s: %s did not have %s" % (self.hostport, peer_hostport, zfh))
-                    atlas_peer_set_zonefile_status( peer_hostport, zfh, False, zonefile_bits=missing_zfinfo[zfh]['indexes'], peer_table=peer_table )
+                    status_updates.append( (zfh, missing_zfinfo[zfh]['indexes'], False) )
+
+                atlas_peer_set_zonefile_statuses( peer_hostport, status_updates, peer_table=peer_table )
 
+                for zfh in peer_requests[peer_hostport]:
                     if zfh in zonefile_origins[peer_hostport]:
                         zonefile_origins[peer_hostport].remove( zfh )
 
-                if locked:
-                    atlas_peer_table_unlock()
-                    peer_table = None
-           
-            # done with this zonefile
-            zonefile_hashes.pop(0)
+            if locked:
+                atlas_peer_table_unlock()
+                peer_table = None
+
+            remaining_zfhashes = [zfh for zfh in next_zfhashes if zfh not in fetched_zfhashes]
 
         log.debug("%s: fetched %s zonefiles" % (self.hostport, num_fetched))
         return num_fetched
@@ -3698,29 +4707,39 @@ class AtlasZonefileCrawler( threading.Thread ):
     
     def run(self):
         self.running = True
-        while self.running:
 
-            t1 = time.time()
-            num_fetched = self.step( path=self.path )
-            t2 = time.time()
+        # one db connection for the life of this thread
+        con = atlasdb_open( self.path )
+        assert con is not None
 
-            if num_fetched == 0 and t2 - t1 < PEER_CRAWL_ZONEFILE_WORK_INTERVAL:
-                deadline = time_now() + PEER_CRAWL_ZONEFILE_WORK_INTERVAL - (t2 - t1) 
-                while time_now() < deadline and self.running:
-                    time_sleep( self.hostport, self.__class__.__name__, 1.0 )
-                
-                if not self.running:
-                    break
+        try:
+            while self.running:
+
+                t1 = time_now()
+                num_fetched = self.step( path=self.path, con=con )
+                t2 = time_now()
+
+                if num_fetched == 0 and t2 - t1 < PEER_CRAWL_ZONEFILE_WORK_INTERVAL:
+                    deadline = atlas_idle_deadline( PEER_CRAWL_ZONEFILE_WORK_INTERVAL, t2 - t1 )
+                    time_sleep_until( self.hostport, self.__class__.__name__, deadline, self.wakeup )
+                    
+                    if not self.running:
+                        break
+
+                # re-try storage periodically for missing zonefiles
+                if self.last_storage_reset + PEER_CRAWL_ZONEFILE_STORAGE_RETRY_INTERVAL < time_now():
+                    log.debug("%s: Re-trying storage on missing zonefiles" % self.hostport)
+                    atlasdb_reset_zonefile_tried_storage( con=con, path=self.path )
+                    self.last_storage_reset = time_now()
 
-            # re-try storage periodically for missing zonefiles
-            if self.last_storage_reset + PEER_CRAWL_ZONEFILE_STORAGE_RETRY_INTERVAL < time_now():
-                log.debug("%s: Re-trying storage on missing zonefiles" % self.hostport)
-                atlasdb_reset_zonefile_tried_storage()
-                self.last_storage_reset = time_now()
+        finally:
+            con.close()
+            self.close_fetch_pool()
 
 
     def ask_join(self):
         self.running = False
+        self.wakeup.set()
 
 
 
@@ -3740,6 +4759,8 @@ class AtlasZonefilePusher(threading.Thread):
             self.path = atlasdb_path()
 
         self.push_timeout = None
+        self.running = False
+        self.wakeup = ZONEFILE_QUEUE_WAKEUP
 
 
     def step( self, peer_table=None, zonefile_queue=None, path=None ):
@@ -3810,9 +4831,9 @@ class AtlasZonefilePusher(threading.Thread):
             t2 = time_now()
             if num_pushed == 0 and t2 - t1 < PEER_PUSH_ZONEFILE_WORK_INTERVAL:
                 
-                deadline = time_now() + PEER_PUSH_ZONEFILE_WORK_INTERVAL - (t2 - t1)
-                while time_now() < deadline and self.running:
-                    time_sleep( self.my_hostport, self.__class__.__name__, 1.0 )
+                deadline = atlas_idle_deadline( PEER_PUSH_ZONEFILE_WORK_INTERVAL, t2 - t1 )
+                # wakes up early on new zonefiles to push
+                time_sleep_until( self.hostport, self.__class__.__name__, deadline, self.wakeup )
                 
                 if not self.running:
                     break
@@ -3820,6 +4841,7 @@ class AtlasZonefilePusher(threading.Thread):
 
     def ask_join(self):
         self.running = False
+        self.wakeup.set()
 
 
 
@@ -3851,4 +4873,5 @@ def atlas_node_stop( atlas_state ):
         atlas_state[component].ask_join()
         atlas_state[component].join()
 
+    atlas_inventory_download_pool_close()
     return True
@@ -58,12 +58,12 @@ HOURS_PER_DAY = 24
 MINUTES_PER_HOUR = 60
 SECONDS_PER_MINUTE = 60
 MINUTES_PER_YEAR = DAYS_PER_YEAR*HOURS_PER_DAY*MINUTES_PER_HOUR
-SECONDS_PER_YEAR = int(round(MINUTES_PER_YEAR*SECONDS_PER_MINUTE))
-BLOCKS_PER_YEAR = int(round(MINUTES_PER_YEAR/AVERAGE_MINUTES_PER_BLOCK))
-BLOCKS_PER_DAY = int(round(float(MINUTES_PER_HOUR * HOURS_PER_DAY)/AVERAGE_MINUTES_PER_BLOCK))
+SECONDS_PER_YEAR = 31556943         # int(round(MINUTES_PER_YEAR*SECONDS_PER_MINUTE))
+BLOCKS_PER_YEAR = 52595             # int(round(MINUTES_PER_YEAR/AVERAGE_MINUTES_PER_BLOCK)); consensus-critical, do not change
+BLOCKS_PER_DAY = (MINUTES_PER_HOUR * HOURS_PER_DAY) // AVERAGE_MINUTES_PER_BLOCK
 EXPIRATION_PERIOD = BLOCKS_PER_YEAR*1
 NAME_PREORDER_EXPIRE = BLOCKS_PER_DAY
-AVERAGE_BLOCKS_PER_HOUR = MINUTES_PER_HOUR/AVERAGE_MINUTES_PER_BLOCK
+AVERAGE_BLOCKS_PER_HOUR = MINUTES_PER_HOUR // AVERAGE_MINUTES_PER_BLOCK
 
 """ blockstack configs
 """
@@ -270,6 +270,9 @@ OPCODE_NAMES = {
     ANNOUNCE: "ANNOUNCE"
 }
 
+# 'op' string of a renewal (a registration with a trailing ':')
+NAME_RENEWAL_OP = NAME_RENEWAL + ':'
+
 NAME_OPCODES = {
     "NAME_PREORDER": NAME_PREORDER,
     "NAME_REGISTRATION": NAME_REGISTRATION,
@@ -284,6 +287,13 @@ NAME_OPCODES = {
     "ANNOUNCE": ANNOUNCE
 }
 
+# opcode sanity checks (compiled out under -O).
+# NAME_RENEWAL deliberately shares NAME_REGISTRATION's byte, so it is not in OPCODES.
+assert len(set(OPCODES)) == len(OPCODES), "BUG: duplicate opcode byte in OPCODES"
+assert all( len(op) == 1 for op in OPCODES ), "BUG: opcodes must be single bytes"
+assert set(OPCODE_NAMES.keys()) == set(OPCODES), "BUG: OPCODE_NAMES does not cover exactly OPCODES"
+assert NAME_RENEWAL == NAME_REGISTRATION and NAME_RENEWAL_OP != NAME_REGISTRATION, "BUG: renewal must be distinguished by its 'op' string"
+
 
 # op-return formats
 LENGTHS = {
@@ -401,6 +411,9 @@ OPCODE_STATELESS_OPS = [
     "ANNOUNCE"
 ]
 
+# every operation that falls into one of the categories above (for fast membership tests)
+OPCODE_CATEGORIZED_OPS = frozenset( OPCODE_PREORDER_OPS + OPCODE_CREATION_OPS + OPCODE_TRANSITION_OPS + OPCODE_STATELESS_OPS )
+
 
 NAMESPACE_LIFE_INFINITE = 0xffffffff
 
@@ -417,6 +430,10 @@ ALPHABETIC_PRICE_FLOOR = 10**4
 
 NAME_COST_UNIT = 100    # 100 satoshis
 
+# characters that determine a name's vowel and non-alphabetic discounts
+NAME_VOWEL_CHARS = frozenset("aeiouy")
+NAME_NONALPHA_CHARS = frozenset("0123456789-_")
+
 NAMESPACE_1_CHAR_COST = 400 * SATOSHIS_PER_BTC        # ~$96,000
 NAMESPACE_23_CHAR_COST = 40 * SATOSHIS_PER_BTC        # ~$9,600
 NAMESPACE_4567_CHAR_COST = 4 * SATOSHIS_PER_BTC       # ~$960
@@ -444,6 +461,13 @@ if os.environ.get("BLOCKSTACK_TEST", None) is not None:
 else:
     NAME_IMPORT_KEYRING_SIZE = 300                  # number of keys to derive from the import key
 
+# namespace cost, indexed by namespace ID length (must come after the test overrides above).
+# index 0 is only reachable by malformed IDs, which have always been priced like 8+ chars.
+NAMESPACE_COST_BY_LENGTH = tuple( [NAMESPACE_8UP_CHAR_COST, NAMESPACE_1_CHAR_COST] + \
+                                  [NAMESPACE_23_CHAR_COST] * 2 + \
+                                  [NAMESPACE_4567_CHAR_COST] * 4 + \
+                                  [NAMESPACE_8UP_CHAR_COST] * (LENGTHS['blockchain_id_namespace_id'] - 7) )
+
 
 NUM_CONFIRMATIONS = 6                         # number of blocks to wait for before accepting names
 if os.environ.get("BLOCKSTACK_TEST", None) == "1":
@@ -452,7 +476,16 @@ if os.environ.get("BLOCKSTACK_TEST", None) == "1":
 
 # burn address for fees (the address of public key 0x0000000000000000000000000000000000000000)
 BLOCKSTACK_BURN_PUBKEY_HASH = "0000000000000000000000000000000000000000"
-BLOCKSTACK_BURN_ADDRESS = virtualchain.hex_hash160_to_address( BLOCKSTACK_BURN_PUBKEY_HASH )   # "1111111111111111111114oLvT2"
+
+# virtualchain.hex_hash160_to_address( BLOCKSTACK_BURN_PUBKEY_HASH ), precomputed for each address version byte
+BLOCKSTACK_BURN_ADDRESSES = {
+    0: "1111111111111111111114oLvT2",               # mainnet
+    111: "mfWxJ45yp2SFn7UciZyNpvDKrzbhyfKrY8",      # testnet and regtest
+}
+
+BLOCKSTACK_BURN_ADDRESS = BLOCKSTACK_BURN_ADDRESSES.get( virtualchain.version_byte, None )
+if BLOCKSTACK_BURN_ADDRESS is None:
+    BLOCKSTACK_BURN_ADDRESS = virtualchain.hex_hash160_to_address( BLOCKSTACK_BURN_PUBKEY_HASH )
 
 # default namespace record (i.e. for names with no namespace ID)
 NAMESPACE_DEFAULT = {
@@ -480,18 +513,28 @@ blockstack_opts = None
 bitcoin_opts = None
 running = False
 
+# (first block, end block, epoch number) of the most recently looked-up epoch.
+# Blocks are mostly processed in order, so this almost always hits.
+EPOCH_NUMBER_CACHE = None
+
 def get_epoch_number( block_height ):
     """
     Which epoch are we in?
     Return integer (>=0) on success
     """
-    global EPOCHS
+    global EPOCHS, EPOCH_NUMBER_CACHE
+
+    cached = EPOCH_NUMBER_CACHE
+    if cached is not None and cached[0] <= block_height and (block_height <= cached[1] or cached[1] == EPOCH_NOW):
+        return cached[2]
 
     if block_height <= EPOCHS[0]['end_block']:
+        EPOCH_NUMBER_CACHE = (float('-inf'), EPOCHS[0]['end_block'], 0)
         return 0
 
     for i in xrange(1, len(EPOCHS)):
         if EPOCHS[i-1]['end_block'] < block_height and (block_height <= EPOCHS[i]['end_block'] or EPOCHS[i]['end_block'] == EPOCH_NOW):
+            EPOCH_NUMBER_CACHE = (EPOCHS[i-1]['end_block'] + 1, EPOCHS[i]['end_block'], i)
             return i
 
     # should never happen 
@@ -560,21 +603,21 @@ blockstack_client_session_opts = None
 def op_get_opcode_name( op_string ):
     """
     Get the name of an opcode, given the operation's 'op' byte sequence.
+    This is called for every parsed and replayed operation, so
+    it dispatches with a single dict lookup on the opcode byte.
     """
-    return blockstack_client.config.op_get_opcode_name( op_string )
-    '''
     global OPCODE_NAMES
 
     # special case...
-    if op_string == "%s:" % NAME_REGISTRATION:
+    if op_string == NAME_RENEWAL_OP:
         return "NAME_RENEWAL"
 
     op = op_string[0]
-    if op not in OPCODE_NAMES.keys():
+    opcode_name = OPCODE_NAMES.get(op, None)
+    if opcode_name is None:
         raise Exception("No such operation '%s'" % op)
 
-    return OPCODE_NAMES[op]
-    '''
+    return opcode_name
 
 
 def get_default_virtualchain_impl():
@@ -803,7 +803,7 @@ def namedb_state_transition( cur, opcode, op_data, block_id, vtxindex, txid, his
     
     # sanity check: must be a state-transitioning operation
     try:
-        assert opcode in OPCODE_NAME_STATE_TRANSITIONS + OPCODE_NAMESPACE_STATE_TRANSITIONS, "BUG: opcode '%s' is not a state-transition"
+        assert opcode in OPCODE_TRANSITION_OPS, "BUG: opcode '%s' is not a state-transition"
     except Exception, e:
         log.exception(e)
         log.error("BUG: opcode '%s' is not a state-transition operation" % opcode)
@@ -896,7 +896,7 @@ def namedb_state_create( cur, opcode, new_record, block_id, vtxindex, txid, hist
     """
 
     # sanity check: must be a state-creation operation 
-    if opcode not in OPCODE_NAME_STATE_CREATIONS + OPCODE_NAMESPACE_STATE_CREATIONS or opcode in OPCODE_NAME_STATE_IMPORTS:
+    if opcode not in OPCODE_CREATION_OPS or opcode in OPCODE_NAME_STATE_IMPORTS:
         log.error("FATAL: Opcode '%s' is not a state-creating operation" % opcode)
         os.abort()
 
@@ -1096,7 +1096,7 @@ def namedb_state_create_from_prior_history( cur, opcode, new_record, block_id, v
     """
 
     # sanity check: must be a state-creation operation 
-    if opcode not in OPCODE_NAME_STATE_CREATIONS + OPCODE_NAMESPACE_STATE_CREATIONS:
+    if opcode not in OPCODE_CREATION_OPS:
         log.error("FATAL: Opcode '%s' is not a state-creating operation" % opcode)
         os.abort()
        
@@ -338,7 +338,7 @@ def db_commit( block_id, op, op_data, txid, vtxindex, db_state=None ):
                 assert op_data['vtxindex'] == vtxindex, "BUG: vtxindex mismatch"
                 # opcode = op_get_opcode_name( op_data['op'] )
                 opcode = op_data.get('opcode', None)
-                assert opcode in OPCODE_PREORDER_OPS + OPCODE_CREATION_OPS + OPCODE_TRANSITION_OPS + OPCODE_STATELESS_OPS, \
+                assert opcode in OPCODE_CATEGORIZED_OPS, \
                                 "BUG: uncategorized opcode '%s'" % opcode
 
             except Exception, e:
@@ -138,13 +138,15 @@ def price_name( name, namespace, block_height ):
    else:
        bucket_exponent = buckets[-1]
 
+   name_lower = name.lower()
+
    # no vowel discount?
-   if sum( [name.lower().count(v) for v in ["a", "e", "i", "o", "u", "y"]] ) == 0:
+   if NAME_VOWEL_CHARS.isdisjoint( name_lower ):
        # no vowels!
        discount = max( discount, namespace['no_vowel_discount'] )
 
    # non-alpha discount?
-   if sum( [name.lower().count(v) for v in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "-", "_"]] ) > 0:
+   if not NAME_NONALPHA_CHARS.isdisjoint( name_lower ):
        # non-alpha!
        discount = max( discount, namespace['nonalpha_discount'] )
 
@@ -163,14 +165,9 @@ def price_namespace( namespace_id, block_height ):
 
    price_multiplier = get_epoch_price_multiplier( block_height, namespace_id )
 
-   if len(namespace_id) == 1:
-       return NAMESPACE_1_CHAR_COST * price_multiplier
-
-   elif len(namespace_id) in [2, 3]:
-       return NAMESPACE_23_CHAR_COST * price_multiplier
-
-   elif len(namespace_id) in [4, 5, 6, 7]:
-       return NAMESPACE_4567_CHAR_COST * price_multiplier
+   namespace_id_len = len(namespace_id)
+   if namespace_id_len < len(NAMESPACE_COST_BY_LENGTH):
+       return NAMESPACE_COST_BY_LENGTH[namespace_id_len] * price_multiplier
 
    else:
        return NAMESPACE_8UP_CHAR_COST * price_multiplier
@@ -0,0 +1,786 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Blockstack
+    ~~~~~
+    copyright: (c) 2014-2015 by Halfmoon Labs, Inc.
+    copyright: (c) 2016 by Blockstack.org
+
+    This file is part of Blockstack
+
+    Blockstack is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Blockstack is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Blockstack. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import pybitcoin
+import virtualchain
+
+# Hack around absolute paths
+current_dir = os.path.abspath(os.path.dirname(__file__))
+parent_dir = os.path.abspath(current_dir + "/../../../")
+
+sys.path.insert(0, parent_dir)
+
+from blockstack.lib import atlas, config, scripts
+
+
+def naive_test_bit( inv_vec, bit_index ):
+    """
+    Is a bit set?  One bit at a time, the slow way.
+    """
+    inv_vec = bytearray(inv_vec)
+    if bit_index / 8 >= len(inv_vec):
+        return False
+
+    return (inv_vec[bit_index / 8] & (1 << (7 - (bit_index % 8)))) != 0
+
+
+def random_inventory( rand, max_len ):
+    return "".join( [chr(rand.randint(0, 255)) for i in xrange(0, rand.randint(0, max_len))] )
+
+
+class AtlasInventoryBitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(0)
+
+    def test_set_clear_bits(self):
+        """ Check setting and clearing bits in string and bytearray inventories
+        """
+        inv = atlas.atlas_inventory_set_zonefile_bits( "", [0, 9, 23] )
+        self.assertIsInstance( inv, str )
+        self.assertEqual( inv, "\x80\x40\x01" )
+
+        inv = atlas.atlas_inventory_clear_zonefile_bits( inv, [9] )
+        self.assertEqual( inv, "\x80\x00\x01" )
+
+        # bytearrays are modified in place
+        inv_bytes = bytearray("\x00")
+        ret = atlas.atlas_inventory_set_zonefile_bits( inv_bytes, [1, 2, 17] )
+        self.assertIs( ret, inv_bytes )
+        self.assertEqual( str(inv_bytes), "\x60\x00\x40" )
+
+        ret = atlas.atlas_inventory_clear_zonefile_bits( inv_bytes, [1, 17] )
+        self.assertIs( ret, inv_bytes )
+        self.assertEqual( str(inv_bytes), "\x20\x00\x00" )
+
+        # no bits, no change
+        self.assertEqual( atlas.atlas_inventory_set_zonefile_bits( "\x01", [] ), "\x01" )
+
+    def test_flip_bits(self):
+        """ Check flipping bits against a bit-by-bit reference
+        """
+        for i in xrange(0, 50):
+            inv = random_inventory( self.rand, 8 )
+            bit_indexes = self.rand.sample( xrange(0, 80), self.rand.randint(1, 10) )
+            operation = self.rand.choice([True, False])
+
+            new_inv = atlas.atlas_inventory_flip_zonefile_bits( inv, bit_indexes, operation )
+            self.assertEqual( str(atlas.atlas_inventory_flip_zonefile_bits( bytearray(inv), bit_indexes, operation )), new_inv )
+
+            for bit_index in xrange(0, len(new_inv) * 8):
+                if bit_index in bit_indexes:
+                    self.assertEqual( naive_test_bit( new_inv, bit_index ), operation )
+                else:
+                    self.assertEqual( naive_test_bit( new_inv, bit_index ), naive_test_bit( inv, bit_index ) )
+
+    def test_test_bits(self):
+        """ Check testing bits against a bit-by-bit reference
+        """
+        for i in xrange(0, 50):
+            inv = random_inventory( self.rand, 8 )
+            for inv_vec in [inv, bytearray(inv)]:
+                bit_indexes = self.rand.sample( xrange(0, 80), self.rand.randint(2, 4) )
+                expected = all( [naive_test_bit( inv_vec, bit_index ) for bit_index in bit_indexes] )
+                self.assertEqual( atlas.atlas_inventory_test_zonefile_bits( inv_vec, bit_indexes ), expected )
+
+    def test_test_single_bit(self):
+        """ Check the single-bit test against a bit-by-bit reference
+        """
+        for i in xrange(0, 50):
+            inv = random_inventory( self.rand, 8 )
+            for inv_vec in [inv, bytearray(inv)]:
+                for bit_index in xrange(0, 80):
+                    expected = naive_test_bit( inv_vec, bit_index )
+                    self.assertEqual( atlas.atlas_inventory_test_zonefile_bit( inv_vec, bit_index ), expected )
+                    self.assertEqual( atlas.atlas_inventory_test_zonefile_bits( inv_vec, [bit_index] ), expected )
+
+
+class FakeBlockstackDB(object):
+    """
+    Just enough of a BlockstackDB for atlasdb_init()
+    """
+    lastblock = atlas.FIRST_BLOCK_MAINNET
+
+    def get_atlas_zonefile_info_at( self, block_height ):
+        return []
+
+
+def make_zonefile_hash( i ):
+    return "%040x" % i
+
+
+class AtlasDBTestCase(unittest.TestCase):
+    """
+    Test case with a fresh atlas db in a scratch working directory
+    """
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.saved_working_dir = os.environ.get("VIRTUALCHAIN_WORKING_DIR", None)
+        os.environ["VIRTUALCHAIN_WORKING_DIR"] = self.working_dir
+
+        self.atlasdb_path = os.path.join( self.working_dir, "atlas.db" )
+        atlas.atlasdb_init( self.atlasdb_path, FakeBlockstackDB(), [], [] )
+
+    def tearDown(self):
+        # don't leak this db's in-RAM state into other tests
+        atlas.ZONEFILE_INV = None
+        atlas.MISSING_ZONEFILES = None
+
+        if self.saved_working_dir is None:
+            del os.environ["VIRTUALCHAIN_WORKING_DIR"]
+        else:
+            os.environ["VIRTUALCHAIN_WORKING_DIR"] = self.saved_working_dir
+
+        shutil.rmtree( self.working_dir )
+
+    def add_zonefile( self, i, present=False ):
+        zfhash = make_zonefile_hash(i)
+        atlas.atlasdb_add_zonefile_info( "name%s.test" % i, zfhash, "txid%s" % i, present, atlas.FIRST_BLOCK_MAINNET + i, path=self.atlasdb_path )
+        return zfhash
+
+
+class AtlasZonefileInventoryTest(AtlasDBTestCase):
+
+    def test_make_zonefile_inventory(self):
+        """ Check that the inventory packs present bits the way the old per-byte loop did
+        """
+        rand = random.Random(1)
+        present = [rand.choice([True, False]) for i in xrange(0, 21)]
+        for i in xrange(0, len(present)):
+            self.add_zonefile( i, present=present[i] )
+
+        self.assertEqual( atlas.atlas_make_zonefile_inventory( 0, 0, path=self.atlasdb_path ), "" )
+
+        for (offset, length) in [(0, len(present)), (0, 8), (3, 10), (5, 16)]:
+            bits = present[offset:offset+length]
+            bits += [False] * ((8 - len(bits) % 8) % 8)
+
+            expected = ""
+            for i in xrange(0, len(bits), 8):
+                byte = 0
+                for j in xrange(0, 8):
+                    if bits[i + j]:
+                        byte |= 1 << (7 - j)
+
+                expected += chr(byte)
+
+            self.assertEqual( atlas.atlas_make_zonefile_inventory( offset, length, path=self.atlasdb_path ), expected )
+
+
+class AtlasInventoryDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_get_range = atlas.atlas_peer_get_zonefile_inventory_range
+        self.peer_hostport = "peer.test:6264"
+        self.peer_table = {}
+        atlas.atlas_init_peer_info( self.peer_table, self.peer_hostport )
+
+        self.interval = 524288
+        self.requested = []
+
+    def tearDown(self):
+        atlas.atlas_peer_get_zonefile_inventory_range = self.saved_get_range
+        atlas.atlas_inventory_download_pool_close()
+
+    def mock_ranges( self, ranges ):
+        """
+        Serve ranges[i] for the ith interval (None means failure)
+        """
+        def get_range( my_hostport, peer_hostport, bit_offset, bit_count, timeout=None, peer_table=None ):
+            self.requested.append( bit_offset )
+            return ranges[ bit_offset / self.interval ]
+
+        atlas.atlas_peer_get_zonefile_inventory_range = get_range
+
+    def test_first_range_fails(self):
+        """ Check that a failed first range is charged once and ends the download
+        """
+        self.mock_ranges( [None] + ["\xff" * self.interval] * 5 )
+        inv = atlas.atlas_peer_download_zonefile_inventory( "localhost:6264", self.peer_hostport, 6 * self.interval, peer_table=self.peer_table )
+
+        self.assertEqual( inv, "" )
+        self.assertEqual( self.requested, [0] )
+        self.assertEqual( self.peer_table[self.peer_hostport]['num_requests'], 1 )
+        self.assertEqual( self.peer_table[self.peer_hostport]['num_responses'], 0 )
+
+    def test_stop_at_short_range(self):
+        """ Check that only ranges up to the first short one are kept and charged
+        """
+        full = "\x01" * self.interval
+        self.mock_ranges( [full, full, "\x02\x03", None, full, full] )
+        inv = atlas.atlas_peer_download_zonefile_inventory( "localhost:6264", self.peer_hostport, 6 * self.interval, peer_table=self.peer_table )
+
+        self.assertEqual( inv, full + full + "\x02\x03" )
+        self.assertEqual( self.peer_table[self.peer_hostport]['num_requests'], 3 )
+        self.assertEqual( self.peer_table[self.peer_hostport]['num_responses'], 3 )
+
+        # the pool is reused across calls
+        pool = atlas.atlas_inventory_download_pool()
+        atlas.atlas_peer_download_zonefile_inventory( "localhost:6264", self.peer_hostport, 6 * self.interval, peer_table={} )
+        self.assertIs( atlas.atlas_inventory_download_pool(), pool )
+
+
+def naive_count_missing( inv1, inv2 ):
+    """
+    How many bits are set in inv2 but not in inv1?  One bit at a time.
+    """
+    count = 0
+    for bit_index in xrange(0, len(inv2) * 8):
+        if naive_test_bit( inv2, bit_index ) and not naive_test_bit( inv1, bit_index ):
+            count += 1
+
+    return count
+
+
+class AtlasInventoryCountMissingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(0)
+
+    def test_count_missing(self):
+        """ Check counting missing bits against a bit-by-bit reference
+        """
+        for i in xrange(0, 200):
+            inv_len = self.rand.randint(0, 6)
+            inv1 = "".join( [chr(self.rand.randint(0, 255)) for j in xrange(0, inv_len)] )
+            inv2 = "".join( [chr(self.rand.randint(0, 255)) for j in xrange(0, inv_len)] )
+            self.assertEqual( atlas.atlas_inventory_count_missing( inv1, inv2 ), naive_count_missing( inv1, inv2 ) )
+
+        self.assertEqual( atlas.atlas_inventory_count_missing( "\xff\xff", "\xff\xff" ), 0 )
+        self.assertEqual( atlas.atlas_inventory_count_missing( "\x00\x00", "\xff\xff" ), 16 )
+        self.assertEqual( atlas.atlas_inventory_count_missing( "\xf0\x0f", "\x0f\xf0" ), 8 )
+
+    def test_count_missing_tail(self):
+        """ Check that every bit in the longer inventory's tail counts as missing
+        """
+        for i in xrange(0, 200):
+            inv1 = random_inventory( self.rand, 6 )
+            inv2 = random_inventory( self.rand, 12 )
+            self.assertEqual( atlas.atlas_inventory_count_missing( inv1, inv2 ), naive_count_missing( inv1, inv2 ) )
+
+        self.assertEqual( atlas.atlas_inventory_count_missing( "", "\xff\x01\x80" ), 10 )
+        self.assertEqual( atlas.atlas_inventory_count_missing( "\xff", "\xff\x00\x00" ), 0 )
+        self.assertEqual( atlas.atlas_inventory_count_missing( "\x00\x00\xff", "\x01" ), 1 )
+
+
+class AtlasAvailabilityRankingTest(AtlasDBTestCase):
+
+    def setUp(self):
+        super(AtlasAvailabilityRankingTest, self).setUp()
+
+        self.peer_table = {}
+        for (peer_hostport, peer_inv) in [("a.test:6264", "\xff"), ("b.test:6264", "\x0f"), ("c.test:6264", "\xc0\x01")]:
+            atlas.atlas_init_peer_info( self.peer_table, peer_hostport )
+            atlas.atlas_peer_set_zonefile_inventory( peer_hostport, peer_inv, peer_table=self.peer_table )
+
+        for i in xrange(0, 8):
+            self.add_zonefile( i )
+
+        self.saved_count_missing = atlas.atlas_inventory_count_missing
+        self.num_counts = 0
+
+        def count_missing( inv1, inv2 ):
+            self.num_counts += 1
+            return self.saved_count_missing( inv1, inv2 )
+
+        atlas.atlas_inventory_count_missing = count_missing
+
+    def tearDown(self):
+        atlas.atlas_inventory_count_missing = self.saved_count_missing
+        super(AtlasAvailabilityRankingTest, self).tearDown()
+
+    def test_cache(self):
+        """ Check that availability scores are only recounted when an inventory changes
+        """
+        self.assertEqual( atlas.atlas_rank_peers_by_data_availability( peer_table=self.peer_table ), ["a.test:6264", "b.test:6264", "c.test:6264"] )
+        self.assertEqual( self.num_counts, 3 )
+
+        # cached, and the cache holds no copy of our inventory
+        self.assertEqual( atlas.atlas_rank_peers_by_data_availability( peer_table=self.peer_table ), ["a.test:6264", "b.test:6264", "c.test:6264"] )
+        self.assertEqual( self.num_counts, 3 )
+        for peer_hostport in self.peer_table.keys():
+            for field in self.peer_table[peer_hostport]['availability_cache']:
+                self.assertIsInstance( field, (int, long) )
+
+        # we get zonefiles 0 through 3, so b.test now has the most that we lack
+        for i in xrange(0, 4):
+            atlas.atlasdb_set_zonefile_present( make_zonefile_hash(i), True, path=self.atlasdb_path )
+
+        self.assertEqual( atlas.atlas_rank_peers_by_data_availability( peer_table=self.peer_table ), ["b.test:6264", "a.test:6264", "c.test:6264"] )
+        self.assertEqual( self.num_counts, 6 )
+
+        # one peer's inventory changes
+        atlas.atlas_peer_set_zonefile_inventory( "c.test:6264", "\x00\xff", peer_table=self.peer_table )
+        self.assertEqual( atlas.atlas_rank_peers_by_data_availability( peer_table=self.peer_table ), ["c.test:6264", "b.test:6264", "a.test:6264"] )
+        self.assertEqual( self.num_counts, 7 )
+
+        # a caller-given inventory is always counted
+        self.assertEqual( atlas.atlas_rank_peers_by_data_availability( peer_table=self.peer_table, local_inv="\xff\xff" ), ["c.test:6264", "b.test:6264", "a.test:6264"] )
+        self.assertEqual( self.num_counts, 10 )
+
+
+class AtlasInventoryBitMasksTest(unittest.TestCase):
+
+    def test_test_bit_masks(self):
+        """ Check testing precomputed bit masks against a bit-by-bit reference
+        """
+        rand = random.Random(0)
+        for i in xrange(0, 50):
+            bit_indexes = rand.sample( xrange(0, 80), rand.randint(1, 4) )
+            bit_masks = atlas.atlas_inventory_bit_masks( bit_indexes )
+
+            # the same masks, against many inventories
+            for j in xrange(0, 10):
+                inv = random_inventory( rand, 8 )
+                expected = all( [naive_test_bit( inv, bit_index ) for bit_index in bit_indexes] )
+                self.assertEqual( atlas.atlas_inventory_test_bit_masks( inv, bit_masks ), expected )
+                self.assertEqual( atlas.atlas_inventory_test_bit_masks( bytearray(inv), bit_masks ), expected )
+
+
+class AtlasMissingZonefilesTest(AtlasDBTestCase):
+
+    def setUp(self):
+        super(AtlasMissingZonefilesTest, self).setUp()
+        atlas.atlasdb_cache_zonefile_info( path=self.atlasdb_path )
+
+    def assertCacheMatchesDB(self):
+        cached = atlas.atlas_get_missing_zonefiles()
+        stored = atlas.atlasdb_zonefile_find_missing( 0, 100, path=self.atlasdb_path )
+        self.assertEqual( cached, stored )
+
+        # same types, too (the db's row factory yields bools)
+        for zfrow in cached:
+            self.assertIsInstance( zfrow['present'], bool )
+            self.assertIsInstance( zfrow['tried_storage'], bool )
+
+    def test_cache_rows_match_db_rows(self):
+        """ Check that in-RAM missing zonefile rows look like the db's rows
+        """
+        for i in xrange(1, 4):
+            self.add_zonefile( i )
+
+        self.assertCacheMatchesDB()
+
+        atlas.atlasdb_set_zonefile_tried_storage( make_zonefile_hash(2), True, path=self.atlasdb_path )
+        self.assertCacheMatchesDB()
+
+        atlas.atlasdb_reset_zonefile_tried_storage( path=self.atlasdb_path )
+        self.assertCacheMatchesDB()
+
+        atlas.atlasdb_set_zonefile_present( make_zonefile_hash(1), True, path=self.atlasdb_path )
+        self.assertCacheMatchesDB()
+        self.assertEqual( len(atlas.atlas_get_missing_zonefiles()), 2 )
+
+
+class AtlasZonefileAvailabilityTest(unittest.TestCase):
+
+    def test_zonefile_availability(self):
+        """ Check zonefile availability against a bit-by-bit reference
+        """
+        rand = random.Random(2)
+        missing = []
+        for i in xrange(0, 40):
+            if rand.randint(0, 2) == 0:
+                continue
+
+            # some zonefiles have more than one bit
+            zfhash = make_zonefile_hash( rand.randint(0, 20) )
+            missing.append( {'name': "name%s.test" % i, 'zonefile_hash': zfhash, 'txid': "txid%s" % i, 'inv_index': i + 1, 'tried_storage': False} )
+
+        # atlas_peer_inventory_snapshot omits empty inventories
+        peer_invs = []
+        for i in xrange(0, 10):
+            peer_inv = "".join( [chr(rand.randint(0, 255) & rand.randint(0, 255)) for j in xrange(0, rand.randint(1, 6))] )
+            peer_invs.append( ("peer%s.test:6264" % i, peer_inv) )
+
+        expected = {}
+        for zfinfo in missing:
+            zfhash = zfinfo['zonefile_hash']
+            if zfhash not in expected:
+                expected[zfhash] = {'names': [], 'indexes': [], 'peers': set([])}
+
+            expected[zfhash]['names'].append( zfinfo['name'] )
+            expected[zfhash]['indexes'].append( zfinfo['inv_index'] - 1 )
+            for (peer_hostport, peer_inv) in peer_invs:
+                if naive_test_bit( peer_inv, zfinfo['inv_index'] - 1 ):
+                    expected[zfhash]['peers'].add( peer_hostport )
+
+        availability = atlas.atlas_zonefile_availability( missing, peer_invs )
+
+        self.assertEqual( sorted(availability.keys()), sorted(expected.keys()) )
+        for zfhash in expected.keys():
+            self.assertEqual( availability[zfhash]['names'], expected[zfhash]['names'] )
+            self.assertEqual( availability[zfhash]['indexes'], expected[zfhash]['indexes'] )
+            self.assertEqual( sorted(availability[zfhash]['peers']), sorted(expected[zfhash]['peers']) )
+            self.assertEqual( availability[zfhash]['popularity'], len(expected[zfhash]['peers']) )
+
+        self.assertEqual( atlas.atlas_zonefile_availability( [], peer_invs ), {} )
+
+
+class AtlasRWLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = atlas.AtlasRWLock()
+
+    def run_thread( self, target ):
+        t = threading.Thread( target=target )
+        t.daemon = True
+        t.start()
+        return t
+
+    def test_readers_share(self):
+        """ Check that readers do not exclude each other
+        """
+        self.lock.acquire_read()
+        self.assertTrue( self.lock.is_read_locked() )
+        self.assertTrue( self.lock.is_read_locked_by_me() )
+
+        acquired = threading.Event()
+        def reader():
+            self.lock.acquire_read()
+            acquired.set()
+            self.lock.release_read()
+
+        t = self.run_thread( reader )
+        self.assertTrue( acquired.wait(5) )
+        t.join(5)
+
+        self.lock.release_read()
+        self.assertFalse( self.lock.is_read_locked() )
+        self.assertFalse( self.lock.is_read_locked_by_me() )
+
+    def test_writer_excludes_readers(self):
+        """ Check that a writer keeps readers out until it releases the lock
+        """
+        self.lock.acquire_write()
+
+        acquired = threading.Event()
+        def reader():
+            self.lock.acquire_read()
+            acquired.set()
+            self.lock.release_read()
+
+        t = self.run_thread( reader )
+        self.assertFalse( acquired.wait(0.2) )
+
+        self.lock.release_write()
+        self.assertTrue( acquired.wait(5) )
+        t.join(5)
+
+    def test_waiting_writer_blocks_readers(self):
+        """ Check that a waiting writer keeps new readers out
+        """
+        self.lock.acquire_read()
+
+        write_acquired = threading.Event()
+        read_acquired = threading.Event()
+
+        def writer():
+            self.lock.acquire_write()
+            write_acquired.set()
+            self.lock.release_write()
+
+        def reader():
+            self.lock.acquire_read()
+            read_acquired.set()
+            self.lock.release_read()
+
+        writer_thread = self.run_thread( writer )
+
+        # wait for the writer to queue up
+        for i in xrange(0, 500):
+            if self.lock.writers_waiting > 0:
+                break
+
+            time.sleep(0.01)
+
+        self.assertEqual( self.lock.writers_waiting, 1 )
+
+        reader_thread = self.run_thread( reader )
+        self.assertFalse( write_acquired.wait(0.2) )
+        self.assertFalse( read_acquired.is_set() )
+
+        # writer goes first, then the new reader
+        self.lock.release_read()
+        self.assertTrue( write_acquired.wait(5) )
+        self.assertTrue( read_acquired.wait(5) )
+
+        writer_thread.join(5)
+        reader_thread.join(5)
+
+
+class AtlasZonefileCrawlerTest(AtlasDBTestCase):
+
+    def setUp(self):
+        super(AtlasZonefileCrawlerTest, self).setUp()
+
+        self.peer_table = {}
+        self.saved = {}
+        for attr in ["PEER_CRAWL_ZONEFILE_BATCH_SIZE", "atlas_get_zonefiles", "is_zonefile_cached", "store_zonefile_data_to_storage"]:
+            self.saved[attr] = getattr(atlas, attr)
+
+    def tearDown(self):
+        for attr in self.saved.keys():
+            setattr(atlas, attr, self.saved[attr])
+
+        super(AtlasZonefileCrawlerTest, self).tearDown()
+
+    def add_unobtainable_zonefile( self, i ):
+        zfhash = self.add_zonefile( i )
+        atlas.atlasdb_set_zonefile_tried_storage( zfhash, True, path=self.atlasdb_path )
+        return zfhash
+
+    def test_available_zonefile_past_unavailable_batch(self):
+        """ Check that unobtainable zonefiles do not starve the crawler
+        """
+        batch_size = 10
+        atlas.PEER_CRAWL_ZONEFILE_BATCH_SIZE = batch_size
+
+        # more unobtainable zonefiles than fit in one batch, then one that a peer has
+        for i in xrange(0, batch_size + 5):
+            self.add_unobtainable_zonefile(i)
+
+        available_zfhash = self.add_unobtainable_zonefile( batch_size + 5 )
+
+        peer_hostport = "peer.test:6264"
+        atlas.atlas_init_peer_info( self.peer_table, peer_hostport )
+        self.peer_table[peer_hostport]['zonefile_inv'] = atlas.atlas_inventory_flip_zonefile_bits( "\0" * 4, [batch_size + 5], True )
+
+        requested = []
+        def get_zonefiles( my_hostport, peer_hostport, zonefile_hashes, timeout=None, peer_table=None ):
+            requested.extend( zonefile_hashes )
+            return dict([(zfhash, "zonefile") for zfhash in zonefile_hashes if zfhash == available_zfhash])
+
+        atlas.atlas_get_zonefiles = get_zonefiles
+        atlas.is_zonefile_cached = lambda *args, **kw: False
+        atlas.store_zonefile_data_to_storage = lambda *args, **kw: True
+
+        crawler = atlas.AtlasZonefileCrawler( "localhost", 6264, path=self.atlasdb_path )
+        try:
+            num_fetched = crawler.step( path=self.atlasdb_path, peer_table=self.peer_table )
+        finally:
+            crawler.close_fetch_pool()
+
+        self.assertEqual( num_fetched, 1 )
+        self.assertEqual( requested, [available_zfhash] )
+
+        missing = atlas.atlasdb_zonefile_find_missing( 0, 100, path=self.atlasdb_path )
+        self.assertEqual( len(missing), batch_size + 5 )
+        self.assertNotIn( available_zfhash, [zfrow['zonefile_hash'] for zfrow in missing] )
+
+    def test_select_merges_pages(self):
+        """ Check that a zonefile split across pages is merged before the batch is cut
+        """
+        def make_stream():
+            return [
+                (make_zonefile_hash(1), {'names': ['a.test'], 'txid': 'txa', 'indexes': [0], 'popularity': 1, 'peers': ['p1:1'], 'tried_storage': True}),
+                (make_zonefile_hash(2), {'names': ['b.test'], 'txid': 'txb', 'indexes': [1], 'popularity': 3, 'peers': ['p1:1', 'p2:1', 'p3:1'], 'tried_storage': True}),
+                (make_zonefile_hash(1), {'names': ['c.test'], 'txid': 'txc', 'indexes': [5], 'popularity': 1, 'peers': ['p2:1'], 'tried_storage': True}),
+                (make_zonefile_hash(3), {'names': ['d.test'], 'txid': 'txd', 'indexes': [6], 'popularity': 0, 'peers': [], 'tried_storage': True}),
+                (make_zonefile_hash(4), {'names': ['e.test'], 'txid': 'txe', 'indexes': [7], 'popularity': 0, 'peers': [], 'tried_storage': False}),
+            ]
+
+        # unobtainable zonefile 3 is skipped; zonefile 4 can still be tried in storage
+        selected = atlas.atlas_select_missing_zonefiles( make_stream(), 2 )
+        self.assertEqual( sorted(selected.keys()), [make_zonefile_hash(1), make_zonefile_hash(4)] )
+
+        zfinfo = selected[make_zonefile_hash(1)]
+        self.assertEqual( zfinfo['names'], ['a.test', 'c.test'] )
+        self.assertEqual( zfinfo['indexes'], [0, 5] )
+        self.assertEqual( sorted(zfinfo['peers']), ['p1:1', 'p2:1'] )
+        self.assertEqual( zfinfo['popularity'], 2 )
+
+        selected = atlas.atlas_select_missing_zonefiles( make_stream(), 10 )
+        self.assertEqual( sorted(selected.keys()), [make_zonefile_hash(1), make_zonefile_hash(2), make_zonefile_hash(4)] )
+
+
+class AtlasPeerZonefileStatusTest(AtlasDBTestCase):
+
+    def test_set_zonefile_statuses(self):
+        """ Check that a batch of status updates rewrites the inventory once
+        """
+        peer_table = {}
+        peer_hostport = "peer.test:6264"
+        atlas.atlas_init_peer_info( peer_table, peer_hostport )
+        atlas.atlas_peer_set_zonefile_inventory( peer_hostport, "\x0f", peer_table=peer_table )
+        version = peer_table[peer_hostport]['zonefile_inv_version']
+
+        for i in xrange(1, 3):
+            self.add_zonefile( i )
+
+        updates = [
+            (make_zonefile_hash(0), [0, 9], True),
+            (make_zonefile_hash(1), None, True),        # bit 0, from the db
+            (make_zonefile_hash(2), None, False),       # bit 1, from the db
+            (make_zonefile_hash(3), [4], False),
+            (make_zonefile_hash(4), [4, 5], True),      # bit 4 is also cleared, so it stays clear
+        ]
+
+        atlas.atlas_peer_set_zonefile_statuses( peer_hostport, updates, peer_table=peer_table, path=self.atlasdb_path )
+
+        self.assertEqual( peer_table[peer_hostport]['zonefile_inv'], "\x87\x40" )
+        self.assertIsInstance( peer_table[peer_hostport]['zonefile_inv'], str )
+        self.assertEqual( peer_table[peer_hostport]['zonefile_inv_version'], version + 1 )
+
+        # nothing to do
+        atlas.atlas_peer_set_zonefile_statuses( peer_hostport, [], peer_table=peer_table, path=self.atlasdb_path )
+        self.assertEqual( peer_table[peer_hostport]['zonefile_inv_version'], version + 1 )
+
+        # unknown peers are ignored
+        atlas.atlas_peer_set_zonefile_statuses( "unknown.test:6264", updates, peer_table=peer_table, path=self.atlasdb_path )
+        self.assertNotIn( "unknown.test:6264", peer_table )
+
+
+# prints the burn address, and the burn fee found in an output paying the
+# network's own encoding of the burn pubkey hash (run once per network)
+BURN_FEE_SCRIPT = """
+import pybitcoin, virtualchain
+from blockstack.lib import config, scripts
+addr = pybitcoin.hex_hash160_to_address( config.BLOCKSTACK_BURN_PUBKEY_HASH, version_byte=virtualchain.version_byte )
+output = {'value': 0.001, 'scriptPubKey': {'asm': 'OP_DUP', 'hex': '', 'addresses': [addr]}}
+print config.BLOCKSTACK_BURN_ADDRESS, scripts.get_burn_fee_from_outputs( [output] )
+"""
+
+
+class BurnAddressTest(unittest.TestCase):
+
+    def test_burn_addresses(self):
+        """ Check the precomputed burn address for each version byte
+        """
+        for version_byte in [0, 111]:
+            expected = pybitcoin.hex_hash160_to_address( config.BLOCKSTACK_BURN_PUBKEY_HASH, version_byte=version_byte )
+            self.assertEqual( config.BLOCKSTACK_BURN_ADDRESSES[version_byte], expected )
+
+        self.assertEqual( config.BLOCKSTACK_BURN_ADDRESS, virtualchain.hex_hash160_to_address( config.BLOCKSTACK_BURN_PUBKEY_HASH ) )
+
+    def test_burn_address_by_network(self):
+        """ Check that mainnet and testnet each select their own burn address
+        """
+        for (testnet, version_byte) in [("0", 0), ("1", 111)]:
+            env = dict(os.environ)
+            env['BLOCKSTACK_TESTNET'] = testnet
+            env['PYTHONPATH'] = parent_dir
+
+            out = subprocess.check_output( [sys.executable, "-c", BURN_FEE_SCRIPT], env=env )
+            burn_address, burn_fee = out.strip().split("\n")[-1].split(" ")
+
+            self.assertEqual( burn_address, config.BLOCKSTACK_BURN_ADDRESSES[version_byte] )
+            self.assertEqual( burn_fee, "100000" )
+
+
+def old_price_namespace( namespace_id, block_height ):
+    """
+    price_namespace, as it was before the cost-by-length table
+    """
+    price_multiplier = config.get_epoch_price_multiplier( block_height, namespace_id )
+
+    if len(namespace_id) == 1:
+        return config.NAMESPACE_1_CHAR_COST * price_multiplier
+
+    elif len(namespace_id) in [2, 3]:
+        return config.NAMESPACE_23_CHAR_COST * price_multiplier
+
+    elif len(namespace_id) in [4, 5, 6, 7]:
+        return config.NAMESPACE_4567_CHAR_COST * price_multiplier
+
+    else:
+        return config.NAMESPACE_8UP_CHAR_COST * price_multiplier
+
+
+def old_price_name( name, namespace, block_height ):
+    """
+    price_name, as it was before the character-set checks
+    """
+    base = namespace['base']
+    coeff = namespace['coeff']
+    buckets = namespace['buckets']
+
+    bucket_exponent = 0
+    discount = 1.0
+
+    if len(name) < len(buckets):
+        bucket_exponent = buckets[len(name)-1]
+    else:
+        bucket_exponent = buckets[-1]
+
+    # no vowel discount?
+    if sum( [name.lower().count(v) for v in ["a", "e", "i", "o", "u", "y"]] ) == 0:
+        discount = max( discount, namespace['no_vowel_discount'] )
+
+    # non-alpha discount?
+    if sum( [name.lower().count(v) for v in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "-", "_"]] ) > 0:
+        discount = max( discount, namespace['nonalpha_discount'] )
+
+    price = (float(coeff * (base ** bucket_exponent)) / float(discount)) * config.NAME_COST_UNIT
+    if price < config.NAME_COST_UNIT:
+        price = config.NAME_COST_UNIT
+
+    price_multiplier = config.get_epoch_price_multiplier( block_height, namespace['namespace_id'] )
+    return price * price_multiplier
+
+
+
+class PricingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.block_heights = [config.FIRST_BLOCK_MAINNET, config.FIRST_BLOCK_MAINNET + 100000]
+
+    def test_price_namespace(self):
+        """ Check namespace prices against the old length rules
+        """
+        namespace_ids = ["id", "helloworld"] + ["a" * i for i in xrange(0, config.LENGTHS['blockchain_id_namespace_id'] + 3)]
+        for block_height in self.block_heights:
+            for namespace_id in namespace_ids:
+                self.assertEqual( scripts.price_namespace( namespace_id, block_height ), old_price_namespace( namespace_id, block_height ) )
+
+    def test_price_name(self):
+        """ Check name prices against the old discount rules
+        """
+        namespace = {
+            'namespace_id': 'test',
+            'base': 4,
+            'coeff': 250,
+            'buckets': [6, 5, 4, 3, 2, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            'no_vowel_discount': 10,
+            'nonalpha_discount': 10,
+        }
+
+        names = ["a", "bcd", "hello", "HELLO", "rhythm", "myth", "h3ll0", "bcd-fgh", "b_c", "0", "123", "aeiouy", "x" * 20, "q" * 16, "q" * 15]
+        for block_height in self.block_heights:
+            for name in names:
+                self.assertEqual( scripts.price_name( name, namespace, block_height ), old_price_name( name, namespace, block_height ) )
+
+
+if __name__ == '__main__':
+
+    unittest.main()
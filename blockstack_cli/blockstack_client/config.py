@@ -27,6 +27,7 @@ import copy
 import traceback
 import uuid
 import urllib2
+import re
 
 import virtualchain
 from .backend.utxo import *
@@ -381,52 +382,69 @@ def op_get_opcode_name( op_string ):
     return OPCODE_NAMES[op]
 
 
+# the network location of a URL: everything up to the first path, query, or fragment delimiter
+URL_NETLOC_PATTERN = re.compile(r"^([^/?#]*)")
+
+URL_TO_HOST_PORT_CACHE = {}
+URL_TO_HOST_PORT_CACHE_MAX = 4096
+
 def url_to_host_port( url, port=DEFAULT_BLOCKSTACKD_PORT ):
     """
     Given a URL, turn it into (host, port).
     Return (None, None) on invalid URL
     """
-    if not url.startswith("http://") or not url.startswith("https://"):
-        url = "http://" + url
+    global URL_TO_HOST_PORT_CACHE
+
+    cache_key = (url, port)
+    ret = URL_TO_HOST_PORT_CACHE.get(cache_key, None)
+    if ret is not None:
+        return ret
 
-    urlinfo = urllib2.urlparse.urlparse(url)
-    hostport = urlinfo.netloc
+    # NOTE: the URL is always treated as if it were prefixed with "http://",
+    # so the netloc is everything before the first '/', '?', or '#'
+    hostport = URL_NETLOC_PATTERN.match(url).group(1)
 
+    ret = None
     parts = hostport.split("@")
-    if len(parts) > 2:
-        return (None, None)
+    if len(parts) > 2 or (("[" in hostport) != ("]" in hostport)):
+        # too many '@', or a malformed IPv6 literal
+        ret = (None, None)
 
-    if len(parts) == 2:
-        hostport = parts[1]
+    else:
+        if len(parts) == 2:
+            hostport = parts[1]
 
-    parts = hostport.split(":")
-    if len(parts) > 2:
-        return (None, None)
+        parts = hostport.split(":")
+        if len(parts) > 2:
+            ret = (None, None)
 
-    if len(parts) == 2:
-        try:
-            port = int(parts[1])
-            assert port > 0 and port < 65535, "Invalid port"
-        except:
-            return (None, None)
+        elif len(parts) == 2:
+            try:
+                port = int(parts[1])
+                assert port > 0 and port < 65535, "Invalid port"
+                ret = (parts[0], port)
+            except:
+                ret = (None, None)
 
-    return parts[0], port
+        else:
+            ret = (parts[0], port)
+
+    if len(URL_TO_HOST_PORT_CACHE) >= URL_TO_HOST_PORT_CACHE_MAX:
+        URL_TO_HOST_PORT_CACHE.clear()
+
+    URL_TO_HOST_PORT_CACHE[cache_key] = ret
+    return ret
 
 
 def atlas_inventory_to_string( inv ):
     """
     Inventory to string (bitwise big-endian)
     """
-    ret = ""
-    for i in xrange(0, len(inv)):
-        for j in xrange(0, 8):
-            bit_index = 1 << (7 - j)
-            val = (ord(inv[i]) & bit_index)
-            if val != 0:
-                ret += "1"
-            else:
-                ret += "0"
+    if len(inv) == 0:
+        return ""
 
+    # render all bits at once, and restore the leading 0's
+    ret = bin(int(hexlify(inv), 16))[2:].zfill(len(inv) * 8)
     return ret
 
 
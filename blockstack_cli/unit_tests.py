@@ -27,8 +27,9 @@ import os
 import sys
 import json
 import unittest
+import urlparse
 
-from blockstack_client import client
+from blockstack_client import client, config
 from blockstack_client.utils import print_result as pprint
 from blockstack_client.config import BLOCKSTACKD_SERVER, BLOCKSTACKD_PORT, CONFIG_DIR
 
@@ -88,6 +89,100 @@ class BlockstackClientTest(unittest.TestCase):
 
         self.assertIsInstance(resp, dict, msg="Not json")
 
+
+def old_url_to_host_port(url, port):
+    """ url_to_host_port, as it was before it was memoized
+    """
+
+    url = "http://" + url
+    hostport = urlparse.urlparse(url).netloc
+
+    parts = hostport.split("@")
+    if len(parts) > 2:
+        return (None, None)
+
+    if len(parts) == 2:
+        hostport = parts[1]
+
+    parts = hostport.split(":")
+    if len(parts) > 2:
+        return (None, None)
+
+    if len(parts) == 2:
+        try:
+            port = int(parts[1])
+            assert port > 0 and port < 65535, "Invalid port"
+        except:
+            return (None, None)
+
+    return parts[0], port
+
+
+class URLToHostPortTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_cache_max = config.URL_TO_HOST_PORT_CACHE_MAX
+        config.URL_TO_HOST_PORT_CACHE.clear()
+
+    def tearDown(self):
+        config.URL_TO_HOST_PORT_CACHE_MAX = self.saved_cache_max
+        config.URL_TO_HOST_PORT_CACHE.clear()
+
+    def test_matches_old_parser(self):
+        """ Check that URLs parse the same way they did before memoization
+        """
+
+        urls = [
+            "node.blockstack.org",
+            "node.blockstack.org:6264",
+            "node.blockstack.org:6264/RPC2",
+            "node.blockstack.org/path:1234",
+            "node.blockstack.org?q=1:2",
+            "node.blockstack.org#frag",
+            "user@node.blockstack.org:6264",
+            "user:pass@node.blockstack.org:6264",
+            "a@b@node.blockstack.org",
+            "node.blockstack.org:0",
+            "node.blockstack.org:65535",
+            "node.blockstack.org:65534",
+            "node.blockstack.org:port",
+            "node.blockstack.org:1:2",
+            "127.0.0.1:16264",
+            "http://node.blockstack.org:6264",
+            "",
+        ]
+
+        for url in urls:
+            for port in [6264, 16264]:
+                expected = old_url_to_host_port(url, port)
+                self.assertEqual(config.url_to_host_port(url, port), expected)
+
+                # and again, from the cache
+                self.assertEqual(config.url_to_host_port(url, port), expected)
+
+        # malformed IPv6 literals are invalid
+        self.assertEqual(config.url_to_host_port("[::1"), (None, None))
+        self.assertEqual(config.url_to_host_port("::1]:6264"), (None, None))
+
+    def test_memoized(self):
+        """ Check that results are cached per (url, port), and the cache stays bounded
+        """
+
+        self.assertEqual(config.url_to_host_port("node.blockstack.org", 6264), ("node.blockstack.org", 6264))
+        self.assertEqual(config.url_to_host_port("node.blockstack.org", 16264), ("node.blockstack.org", 16264))
+        self.assertIn(("node.blockstack.org", 6264), config.URL_TO_HOST_PORT_CACHE)
+        self.assertIn(("node.blockstack.org", 16264), config.URL_TO_HOST_PORT_CACHE)
+
+        # a cached result is returned without re-parsing
+        config.URL_TO_HOST_PORT_CACHE[("node.blockstack.org", 6264)] = ("cached.test", 1234)
+        self.assertEqual(config.url_to_host_port("node.blockstack.org", 6264), ("cached.test", 1234))
+
+        config.URL_TO_HOST_PORT_CACHE_MAX = 10
+        for i in xrange(0, 25):
+            config.url_to_host_port("node%s.blockstack.org" % i)
+            self.assertTrue(len(config.URL_TO_HOST_PORT_CACHE) <= 10)
+
+
 if __name__ == '__main__':
 
     unittest.main()